@@ -0,0 +1,157 @@
+import io
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+from scipy import sparse
+
+"""
+Artifacts shared between stages are stored in binary form:
+arrays (id vocabularies, CSR mappings) as .npy files that can be opened memory-mapped,
+scalars (numbers of problems, students, skills...) in a small manifest.json
+"""
+manifest_file = 'manifest.json'
+
+
+# save array as .npy file
+def save_array(folder, name, arr):
+    np.save(os.path.join(folder, name + '.npy'), np.asarray(arr))
+
+
+"""
+append rows to an array saved by save_array, converted to its dtype, the rows are written at the end of the file and only the header is rewritten,
+so memory-mapped readers of the old rows stay valid, the whole file is rewritten when the new header does not fit
+"""
+def append_array(folder, name, rows):
+    path = os.path.join(folder, name + '.npy')
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if rows.shape[1:] != tuple(shape[1:]):
+            raise ValueError("rows of shape %s cannot be appended to %s of shape %s" % (rows.shape, name, shape))
+        header = io.BytesIO()
+        header_data = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (shape[0] + len(rows),) + tuple(shape[1:])}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_data)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_data)
+        if not fortran_order and not dtype.hasobject and len(header.getvalue()) == data_offset:
+            # data first, so the old header stays valid if writing is interrupted
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+    save_array(folder, name, np.concatenate([load_array(folder, name, mmap_mode=None), rows]))
+
+
+# load array saved by save_array, memory-mapped by default
+def load_array(folder, name, mmap_mode='r'):
+    return np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+
+
+# add scalars to manifest, existing values with the same name are replaced
+def save_manifest(folder, **scalars):
+    manifest = load_manifest(folder) if os.path.exists(os.path.join(folder, manifest_file)) else {}
+    manifest.update(scalars)
+    with open(os.path.join(folder, manifest_file), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def load_manifest(folder):
+    with open(os.path.join(folder, manifest_file), 'r') as f:
+        return json.load(f)
+
+
+# save id vocabulary, id of vocab[i] is i, the sorting order is saved as well for looking up ids
+def save_vocab(folder, name, vocab):
+    vocab = np.asarray(vocab)
+    if vocab.dtype == object:
+        vocab = vocab.astype(str)
+    save_array(folder, name, vocab)
+    save_array(folder, name + '_sorter', np.argsort(vocab, kind='stable'))
+
+
+def load_vocab(folder, name, mmap_mode='r'):
+    return load_array(folder, name, mmap_mode), load_array(folder, name + '_sorter', mmap_mode)
+
+
+# look up ids of keys in vocabulary, keys not in vocabulary get -1
+def lookup_ids(vocab, sorter, keys):
+    keys = np.asarray(keys)
+    if keys.dtype == object and len(keys):
+        keys = np.array(keys.tolist())
+    if vocab.dtype.kind in 'iuf' and keys.dtype.kind in 'US':
+        # numbers given as strings, e.g. on the command line, strings of non-integers are compared as floats
+        try:
+            keys = keys.astype(np.int64)
+        except (ValueError, OverflowError):
+            keys = keys.astype(np.float64)
+    elif vocab.dtype.kind == 'U' and keys.dtype.kind != 'U':
+        keys = keys.astype(str)
+    # keys and vocabulary are compared in a common type, so no key is truncated or wrapped around into another key
+    dtype = np.result_type(vocab.dtype, keys.dtype)
+    keys = keys.astype(dtype, copy=False)
+    sorted_vocab = vocab[sorter].astype(dtype, copy=False)
+    pos = np.minimum(np.searchsorted(sorted_vocab, keys), max(len(vocab) - 1, 0))
+    found = sorted_vocab[pos] == keys if len(vocab) else np.zeros(len(keys), dtype=bool)
+    return np.where(found, sorter[pos], -1)
+
+
+# save mapping in CSR form: values of row i are indices[offsets[i]:offsets[i + 1]]
+def save_csr(folder, name, offsets, indices):
+    save_array(folder, name + '_offsets', np.asarray(offsets, dtype=np.int64))
+    save_array(folder, name + '_indices', np.asarray(indices, dtype=np.int32))
+
+
+def load_csr(folder, name, mmap_mode='r'):
+    return load_array(folder, name + '_offsets', mmap_mode), load_array(folder, name + '_indices', mmap_mode)
+
+
+"""
+open arrays of a .npz file memory-mapped inside the archive, so processes reading the same file share it in page cache,
+arrays stored compressed cannot be mapped and are read into memory
+"""
+def load_npz_mmap(path):
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+            # local file header is 30 bytes followed by file name and extra field, then the .npy file
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or np.prod(shape) == 0:
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+# load sparse matrix saved by scipy.sparse.save_npz, index and data arrays are memory-mapped when saved uncompressed
+def load_sparse(path):
+    arrays = load_npz_mmap(path)
+    # format is saved by scipy as bytes, e.g. b'csr'
+    matrix_format = np.asarray(arrays['format']).item().decode('ascii')
+    shape = tuple(int(size) for size in arrays['shape'])
+    if matrix_format == 'coo':
+        return sparse.coo_matrix((arrays['data'], (arrays['row'], arrays['col'])), shape=shape)
+    if matrix_format == 'csr':
+        return sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+    return sparse.load_npz(path)
@@ -0,0 +1,236 @@
+import argparse
+import ast
+import datetime
+import json
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import HyperParameter
+from Telemetry import record_stage
+
+"""
+Benchmark of the whole workflow on synthetic data:
+original datasets in the schema of Assist09 (skill_id "a_b" for problems with several skills) or Assist12 (one numeric skill_id)
+are generated at several scales, then every ProcessData.py stage, one epoch of TrainEmbedding.py,
+JointEmbedding.py and one epoch of TrainModel.py run one by one in separate processes.
+The cleaned dataset is factorized once (stage index), ProcessData.py stages open the saved index instead of reading the dataset again.
+Wall time and peak memory of each process, and wall time, CPU time and peak memory growth of the stage itself
+as recorded by Telemetry.py, are appended as JSON lines to the results file together with the current commit,
+so results of different commits can be compared.
+"""
+codefolder = os.path.dirname(os.path.abspath(__file__))
+# numbers of students, problems, skills and original records of each scale
+scales = {
+    'small': {'students': 1000, 'problems': 2000, 'skills': 100, 'rows': 100000},
+    'medium': {'students': 10000, 'problems': 20000, 'skills': 300, 'rows': 1000000},
+    'large': {'students': 50000, 'problems': 100000, 'skills': 800, 'rows': 10000000},
+}
+process_stages = ['clean', 'index', 'ids', 'pro_skill', 'pro_diff', 'stu_skill', 'correlation', 'interactions']
+# stages run by scripts, training scripts run one epoch
+script_stages = [('embedding', 'TrainEmbedding.py'), ('joint', 'JointEmbedding.py'), ('predict', 'TrainModel.py')]
+# names of the telemetry records of each stage
+stage_records = {'clean': ('process_data', 'process_data_chunked'), 'index': ('factorize_data',), 'ids': ('extract_pro_stu_id',),
+                 'pro_skill': ('extract_pro_skill',), 'pro_diff': ('extract_pro_diff',), 'stu_skill': ('extract_stu_skill',),
+                 'correlation': ('extract_pro_skill_correlation',), 'interactions': ('extract_stu_pro_skill_corr',),
+                 'embedding': ('train_embedding',), 'joint': ('joint_embedding',), 'predict': ('train_model',)}
+
+
+# write original dataset chunk by chunk, students and problems have skewed activity, correctness depends on ability and difficulty
+def generate(folder, dataset, num_stu, num_pro, num_skill, num_rows, seed=0, chunk_rows=1000000):
+    rng = np.random.RandomState(seed)
+    stu_ids = rng.permutation(num_stu) * 7 + 50000
+    pro_ids = rng.permutation(num_pro) * 3 + 10000
+    first_skill = rng.randint(num_skill, size=num_pro)
+    if dataset == "Assist09":
+        skill_len = np.minimum(rng.choice([1, 2, 3], size=num_pro, p=[0.7, 0.2, 0.1]), num_skill)
+        pro_skill = np.array(['_'.join(str((first + k) % num_skill + 1) for k in range(length))
+                              for first, length in zip(first_skill, skill_len)], dtype=object)
+    else:
+        pro_skill = (first_skill + 1).astype(np.float64)
+    stu_p = rng.lognormal(0, 1, num_stu)
+    stu_p /= stu_p.sum()
+    pro_p = 1. / (np.arange(num_pro) + 10.) ** 0.8
+    pro_p = rng.permutation(pro_p / pro_p.sum())
+    ability, difficulty = rng.normal(size=num_stu), rng.normal(size=num_pro)
+    pro_time = rng.lognormal(10, 0.5, num_pro)
+    datafolder = os.path.join(folder, dataset, 'Data')
+    os.makedirs(datafolder, exist_ok=True)
+    path = os.path.join(datafolder, dataset + '_original.csv')
+    for b in range(0, num_rows, chunk_rows):
+        n = min(chunk_rows, num_rows - b)
+        stu = rng.choice(num_stu, size=n, p=stu_p)
+        pro = rng.choice(num_pro, size=n, p=pro_p)
+        correct = (rng.rand(n) < 1. / (1. + np.exp(difficulty[pro] - ability[stu]))).astype(np.int8)
+        ms = np.round(pro_time[pro] * rng.lognormal(0, 0.5, n))
+        # a few negative and missing answer times, missing skills and scaffolding problems, as in the real datasets
+        ms[rng.rand(n) < 0.02] *= -1
+        ms[rng.rand(n) < 0.01] = np.nan
+        skill = pro_skill[pro]
+        if dataset == "Assist09":
+            skill[rng.rand(n) < 0.02] = None
+        else:
+            skill[rng.rand(n) < 0.02] = np.nan
+        df = pd.DataFrame({'order_id': np.arange(b, b + n), 'user_id': stu_ids[stu], 'problem_id': pro_ids[pro],
+                           'original': (rng.rand(n) < 0.9).astype(np.int8), 'correct': correct,
+                           'ms_first_response': ms, 'skill_id': skill})
+        df.to_csv(path, mode='w' if b == 0 else 'a', header=b == 0, index=False)
+    return path
+
+
+def index_folder(dataset):
+    return os.path.join(dataset, 'Data', 'index')
+
+
+# run a stage of the pipeline or a script in this process, with HyperParameter values overridden
+def run_child(target, overrides):
+    for key, value in overrides.items():
+        setattr(HyperParameter, key, value)
+    dataset = HyperParameter.dataset
+    if target.endswith('.py'):
+        sys.argv = [target]
+        runpy.run_path(os.path.join(codefolder, target), run_name='__main__')
+    elif target == 'index':
+        import ProcessData
+        with record_stage('factorize_data') as record:
+            df = ProcessData.read_data(dataset, 'Data', dataset + '.csv', ProcessData.data_cols)
+            record['rows'] = len(df)
+            ProcessData.save_index(index_folder(dataset), ProcessData.factorize_data(dataset, df))
+    else:
+        import Pipeline
+        import ProcessData
+        stage = [stage for stage in Pipeline.pipeline_stages(dataset) if stage['name'] == target][0]
+        # stages open the index saved by stage index, so they do not read and factorize the dataset again
+        ctx = {'df': None, 'index': ProcessData.load_index(index_folder(dataset))} if os.path.exists(index_folder(dataset)) else {}
+        stage['run'](ctx)
+
+
+# run child process in folder, return its exit code, wall time, peak resident memory and process id
+def measure(folder, target, overrides):
+    command = [sys.executable, os.path.abspath(__file__), 'child', target]
+    for key, value in overrides.items():
+        command += ['--set', '%s=%r' % (key, value)]
+    starttime = time.time()
+    process = subprocess.Popen(command, cwd=folder)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux
+    return process.returncode, time.time() - starttime, usage.ru_maxrss / 1024., process.pid
+
+
+# telemetry record of stage written by process pid, None when telemetry is switched off
+def stage_record(folder, dataset, stage, pid, overrides):
+    telemetry_file = overrides.get('telemetry_file', HyperParameter.telemetry_file)
+    path = os.path.join(folder, dataset, telemetry_file)
+    if not telemetry_file or not os.path.exists(path):
+        return None
+    found = None
+    with open(path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'stage' and record['pid'] == pid and record['name'] in stage_records[stage]:
+                found = record
+    return found
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=codefolder, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# rows processed by a stage: original records for ProcessData.py stages, problems for embedding, answer records for the rest
+def stage_rows(folder, dataset, stage, scale):
+    if stage in process_stages:
+        return scale['rows']
+    if stage == 'embedding':
+        with open(os.path.join(folder, dataset, 'Data', 'manifest.json'), 'r') as f:
+            return json.load(f)['num_pro']
+    return len(np.load(os.path.join(folder, dataset, 'Data', 'stu_pro_skill_corr.npz'))['correct'])
+
+
+def run_benchmark(folder, datasets, scale_names, results, overrides, stages=None):
+    commit = current_commit()
+    for scale_name in scale_names:
+        scale = scales[scale_name]
+        scale_folder = os.path.join(folder, scale_name)
+        for dataset in datasets:
+            starttime = time.time()
+            generate(scale_folder, dataset, scale['students'], scale['problems'], scale['skills'], scale['rows'])
+            # an index of an earlier run does not belong to the new dataset
+            shutil.rmtree(os.path.join(scale_folder, index_folder(dataset)), ignore_errors=True)
+            print("generate %s %s time:" % (scale_name, dataset), time.time() - starttime)
+            stage_overrides = dict(overrides, dataset=dataset)
+            targets = [(stage, stage) for stage in process_stages] + script_stages
+            for stage, target in targets:
+                # the index is always built, the other ProcessData.py stages depend on it
+                if stages and stage not in stages and stage != 'index':
+                    continue
+                if target in ['TrainEmbedding.py', 'TrainModel.py']:
+                    target_overrides = dict(stage_overrides, epochs=1)
+                else:
+                    target_overrides = stage_overrides
+                returncode, wall, peak_rss, pid = measure(scale_folder, target, target_overrides)
+                record = {'commit': commit, 'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                          'dataset': dataset, 'scale': scale_name, 'students': scale['students'], 'problems': scale['problems'],
+                          'skills': scale['skills'], 'original_rows': scale['rows'], 'stage': stage, 'returncode': returncode,
+                          'wall': wall, 'peak_rss_mb': peak_rss, 'overrides': {key: repr(value) for key, value in overrides.items()}}
+                # wall and peak_rss_mb include starting the process and loading inputs, stage_* only cover the stage itself
+                telemetry = stage_record(scale_folder, dataset, stage, pid, target_overrides)
+                if telemetry:
+                    record.update(stage_wall=telemetry['wall'], stage_cpu=telemetry['cpu'], stage_rss_delta_mb=telemetry.get('peak_rss_delta_mb'))
+                if returncode == 0:
+                    record['rows'] = int(stage_rows(scale_folder, dataset, stage, scale))
+                    record['rows_per_sec'] = record['rows'] / record.get('stage_wall', wall)
+                with open(results, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                print("%s %s %s: %.2fs (stage %s), peak %.0f MB%s" % (
+                    scale_name, dataset, stage, wall, '%.3fs' % record['stage_wall'] if 'stage_wall' in record else 'not recorded', peak_rss,
+                    '' if returncode == 0 else ', failed with exit code %d' % returncode))
+                if returncode != 0:
+                    break
+
+
+# parse --set key=value, values are python literals or plain strings
+def parse_overrides(items):
+    overrides = {}
+    for item in items:
+        key, value = item.split('=', 1)
+        try:
+            overrides[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[key] = value
+    return overrides
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'child':
+        child_parser = argparse.ArgumentParser()
+        child_parser.add_argument('target')
+        child_parser.add_argument('--set', action='append', default=[])
+        child_args = child_parser.parse_args(sys.argv[2:])
+        run_child(child_args.target, parse_overrides(child_args.set))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='benchmark PCKT stages on synthetic datasets')
+    parser.add_argument('--folder', default='benchmark', help='folder of generated datasets, one subfolder per scale')
+    parser.add_argument('--datasets', nargs='+', default=['Assist09', 'Assist12'], choices=['Assist09', 'Assist12'])
+    parser.add_argument('--scales', nargs='+', default=['small'], help='some of %s, or custom' % ', '.join(scales))
+    parser.add_argument('--students', type=int, help='number of students of custom scale')
+    parser.add_argument('--problems', type=int, help='number of problems of custom scale')
+    parser.add_argument('--skills', type=int, help='number of skills of custom scale')
+    parser.add_argument('--rows', type=int, help='number of original records of custom scale')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--set', action='append', default=[], help='override a HyperParameter.py value, e.g. --set pro_pro_loss=sampled')
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='JSON lines file results are appended to')
+    args = parser.parse_args()
+    if 'custom' in args.scales:
+        if None in [args.students, args.problems, args.skills, args.rows]:
+            parser.error('custom scale needs --students, --problems, --skills and --rows')
+        scales['custom'] = {'students': args.students, 'problems': args.problems, 'skills': args.skills, 'rows': args.rows}
+    run_benchmark(args.folder, args.datasets, args.scales, os.path.abspath(args.results), parse_overrides(args.set), args.stages)
@@ -0,0 +1,107 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from HyperParameter import *
+from ArtifactStore import load_manifest, load_array, append_array, load_vocab, save_vocab, load_csr, lookup_ids
+from ProcessData import concat_ranges
+from Telemetry import record_stage
+
+"""
+Embeddings of new students without retraining:
+with skill embeddings K (final_skill_embed) fixed, the student-skill loss of TrainEmbedding.py,
+sum over skills of (mastery - s . K[skill])^2 with mastery 0 for skills never answered, is linear least squares in student embedding s,
+so s = y (K K^T + ridge I)^-1 K for mastery vector y, which is the minimum-norm solution as ridge goes to 0.
+The matrix (K K^T + ridge I)^-1 K is computed once, embeddings of a batch of students are one matrix product.
+Mastery is computed from the students' records as in extract_stu_skill of ProcessData.py.
+New students are appended to final_stu_embed and the student vocabulary, so ScoringService.py and Recommend.py can use them,
+and an incremental run of ProcessData.py keeps their ids.
+    python FoldIn.py new_records.csv    (columns user_id, problem_id, correct)
+"""
+datafolder = os.path.join(dataset, 'Data')
+modelfolder = os.path.join(dataset, model_dir)
+# number of students whose mastery matrix is built at a time
+batch_students = 4096
+
+
+# maps student mastery to embeddings, (num_skill, embed_dim)
+def fold_in_projection(skill_embed, ridge):
+    skill_embed = np.asarray(skill_embed, dtype=np.float64)
+    gram = skill_embed.dot(skill_embed.T)
+    ridge = ridge * np.trace(gram) / len(gram)
+    return np.linalg.solve(gram + ridge * np.eye(len(gram)), skill_embed)
+
+
+def load_fold_in():
+    manifest = load_manifest(datafolder)
+    fold_model = {'num_skill': manifest['num_skill']}
+    fold_model['problems'], fold_model['problems_sorter'] = load_vocab(datafolder, 'problems', mmap_mode=None)
+    fold_model['pro_skill_offsets'], fold_model['pro_skill_indices'] = load_csr(datafolder, 'pro_skill', mmap_mode=None)
+    fold_model['projection'] = fold_in_projection(load_array(modelfolder, 'final_skill_embed', mmap_mode=None), fold_in_ridge)
+    return fold_model
+
+
+# mastery of skills of students 0 to num_students - 1 = correct answers / answers of each skill, 0 for skills never answered
+def skill_mastery(fold_model, stu_rows, pro_ids, correct, num_students):
+    offsets, num_skill = fold_model['pro_skill_offsets'], fold_model['num_skill']
+    # each record counts once for every skill of its problem
+    skill_len = offsets[pro_ids + 1] - offsets[pro_ids]
+    lines = np.repeat(np.arange(len(pro_ids)), skill_len)
+    line_skills = fold_model['pro_skill_indices'][concat_ranges(offsets[pro_ids], skill_len)]
+    pairs = stu_rows[lines].astype(np.int64) * num_skill + line_skills
+    total = np.bincount(pairs, minlength=num_students * num_skill).reshape(num_students, num_skill)
+    corr = np.bincount(pairs, weights=correct[lines], minlength=num_students * num_skill).reshape(num_students, num_skill)
+    return np.divide(corr, total, out=np.zeros((num_students, num_skill)), where=total > 0)
+
+
+"""
+embeddings of the students in records given by original user_id, problem_id and correct,
+records of unknown problems are ignored, a student without known problems gets a zero embedding
+"""
+def fold_in(fold_model, user_ids, problem_ids, correct):
+    stu_rows, students = pd.factorize(np.asarray(user_ids))
+    pro = lookup_ids(fold_model['problems'], fold_model['problems_sorter'], problem_ids)
+    known = np.flatnonzero(pro >= 0)
+    # records of each batch of students are contiguous after sorting by student
+    known = known[np.argsort(stu_rows[known], kind='stable')]
+    stu_rows, pro, correct = stu_rows[known], pro[known], np.asarray(correct, dtype=np.float64)[known]
+    embeds = np.zeros((len(students), fold_model['projection'].shape[1]), dtype=np.float32)
+    for b in range(0, len(students), batch_students):
+        e = min(b + batch_students, len(students))
+        lb, le = np.searchsorted(stu_rows, [b, e])
+        mastery = skill_mastery(fold_model, stu_rows[lb:le] - b, pro[lb:le], correct[lb:le], e - b)
+        embeds[b:e] = mastery.dot(fold_model['projection'])
+    return np.asarray(students), embeds
+
+
+"""
+append embeddings of students not in the student vocabulary, students already in it keep their embeddings,
+return ids of all given students and whether each of them is new
+"""
+def append_students(students, embeds):
+    vocab, sorter = load_vocab(datafolder, 'students', mmap_mode=None)
+    num_rows = len(load_array(modelfolder, 'final_stu_embed'))
+    if num_rows != len(vocab):
+        raise ValueError("final_stu_embed has %d rows for %d students, run TrainEmbedding.py again" % (num_rows, len(vocab)))
+    ids = lookup_ids(vocab, sorter, students)
+    new = ids < 0
+    ids[new] = len(vocab) + np.arange(new.sum())
+    if new.any():
+        append_array(modelfolder, 'final_stu_embed', embeds[new])
+        # parameters used to warm start incremental training, they equal final_stu_embed
+        param_path = os.path.join(modelfolder, 'param_stu_embed_matrix.npy')
+        if os.path.exists(param_path) and len(np.load(param_path, mmap_mode='r')) == len(vocab):
+            append_array(modelfolder, 'param_stu_embed_matrix', embeds[new])
+        save_vocab(datafolder, 'students', np.concatenate([vocab, np.asarray(students)[new]]))
+    return ids, new
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='add embeddings of new students without retraining')
+    parser.add_argument('records', help='csv file with columns user_id, problem_id, correct')
+    args = parser.parse_args()
+    df = pd.read_csv(args.records, usecols=['user_id', 'problem_id', 'correct'])
+    with record_stage('fold_in', len(df)):
+        students, embeds = fold_in(load_fold_in(), df['user_id'].values, df['problem_id'].values, df['correct'].values)
+        ids, new = append_students(students, embeds)
+    print("%d new students added, %d already known" % (new.sum(), len(new) - new.sum()))
@@ -9,6 +9,64 @@ early_stop = 20
 keep_rate = 0.5
 # ratio of training set and test set
 split_rate = 0.7
+# keep at most top_k most similar problems (skills) for each problem (skill), 0 means keeping all
+top_k = 0
+# problem-problem and skill-skill similarities below min_simi are dropped
+min_simi = 0.
+# number of lines read at a time when cleaning original dataset, 0 means reading the whole file at once
+chunk_size = 0
+# batch size of evaluating test set in TrainModel.py
+eval_bs = 65536
+# number of probability buckets of the streaming auc computed on test set every epoch, more buckets are more precise
+auc_buckets = 10000
+# also compute exact acc and auc of the final model on test set, which keeps all test predictions in memory
+exact_auc = False
+# number of training batches TrainModel.py reads at a time and shuffles together
+shuffle_batches = 64
+# number of worker processes of ProcessData.py stages and JointEmbedding.py, 0 or 1 runs everything in one process
+num_workers = 0
+# number of lines computed at a time by JointEmbedding.py
+joint_chunk = 65536
+# "file" trains TrainModel.py on final_joint_embed.npy built by JointEmbedding.py,
+# "fused" computes joint embeddings batch by batch inside TrainModel.py, so JointEmbedding.py can be skipped
+joint_mode = "file"
+# loss of problem-problem relationships in TrainEmbedding.py:
+# "exact" compares each problem with all problems,
+# "sampled" only uses related problems and num_neg randomly sampled problems for each problem, for large numbers of problems
+pro_pro_loss = "exact"
+num_neg = 64
+# loss of students' mastery of skills in TrainEmbedding.py:
+# "exact" uses all students at every step,
+# "sampled" uses a different part of students at each step, every student once per epoch, for large numbers of students
+stu_skill_loss = "exact"
+
+# number of k-means lists of the recommendation indexes of Recommend.py, 0 means square root of the number of vectors
+ivf_lists = 0
+# number of lists Recommend.py scans for a query, more lists give higher recall but slower queries
+nprobe = 8
+# file in the dataset folder performance records of stages and epochs are appended to, empty means no records
+telemetry_file = "telemetry.jsonl"
+# name of a stage (e.g. extract_stu_skill, train_embedding) to run under cProfile, empty means no profiling
+profile_stage = ""
+# folder in the dataset folder where TrainEmbedding.py and later programs save models, Sweep.py gives every run its own folder
+model_dir = "Model"
+# numbers of threads TensorFlow uses inside one operation and to run operations in parallel, 0 means TensorFlow's default
+intra_threads = 0
+inter_threads = 0
+# port of ScoringService.py
+serve_port = 8000
+# ScoringService.py scores pairs of requests arriving within serve_wait_ms milliseconds together, at most serve_batch pairs at a time
+serve_batch = 4096
+serve_wait_ms = 2
+# number of student embeddings ScoringService.py keeps in memory
+stu_cache_size = 100000
+# incremental retraining on new logs: ProcessData.py keeps ids of the previous run and records problems and students with new records,
+# TrainEmbedding.py starts from the previous parameters and only trains on those problems and students
+incremental = False
+# TrainEmbedding.py stops when the training loss improves less than converge_tol relative to the previous epoch, 0 means never
+converge_tol = 0.
+# ridge of FoldIn.py solving embeddings of new students, relative to the mean squared norm of skill embeddings
+fold_in_ridge = 1e-3
 
 """
 Here are some non-fixed parameters
@@ -20,3 +78,17 @@ dataset = "Assist09"
 lr = 0.01
 # dimensions of embedding matrix
 embed_dim = 512
+
+"""
+Values can be overridden by environment variables PCKT_<name>, e.g. PCKT_lr=0.001,
+values are python literals, anything else is taken as a string.
+Sweep.py uses them to run several configurations at the same time
+"""
+import ast as _ast
+import os as _os
+for _name, _value in list(_os.environ.items()):
+    if _name.startswith('PCKT_') and _name[len('PCKT_'):] in globals():
+        try:
+            globals()[_name[len('PCKT_'):]] = _ast.literal_eval(_value)
+        except (ValueError, SyntaxError):
+            globals()[_name[len('PCKT_'):]] = _value
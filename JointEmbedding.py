@@ -1,45 +1,73 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from HyperParameter import *
+from Telemetry import record_stage
+from ArtifactStore import load_manifest, load_array, save_array, load_npz_mmap
 
 datafolder = os.path.join(dataset, 'Data')
-modelfolder = os.path.join(dataset, 'Model')
-
-if dataset == "Assist09":
-    with open(os.path.join(datafolder, 'max_skill_len.txt'), 'r') as f:
-        max_skill_len = eval(f.read())
-else:
-    max_skill_len = 1
-
-stu_pro_skill_corr = np.load(os.path.join(datafolder, "stu_pro_skill_corr.npz"), allow_pickle=True)
-stu_pro_skill_corr = np.array(stu_pro_skill_corr["stu_pro_skill_corr"])
-data_num = len(stu_pro_skill_corr)
-stu_id = stu_pro_skill_corr[:, 0]
-pro_id = stu_pro_skill_corr[:, 1]
-skill_id = stu_pro_skill_corr[:, 2]
-true_corr = stu_pro_skill_corr[:, 3]
-
-final_pro_embed = np.load(os.path.join(modelfolder, "final_pro_embed.npz"), allow_pickle=True)["final_pro_embed"]
-final_skill_embed = np.load(os.path.join(modelfolder, "final_skill_embed.npz"), allow_pickle=True)["final_skill_embed"]
-final_stu_embed = np.load(os.path.join(modelfolder, "final_stu_embed.npz"), allow_pickle=True)["final_stu_embed"]
-
-final_joint_embed = np.zeros((data_num, 1 + max_skill_len))
-for line in range(data_num):
-    tmp_stu_embed = final_stu_embed[stu_id[line]]
-    tmp_stu_embed = tmp_stu_embed.reshape(1, embed_dim)
-    tmp_pro_embed = final_pro_embed[pro_id[line]]
-    tmp_pro_embed = tmp_pro_embed.reshape(1, embed_dim)
-    tmp_skill_embed = np.zeros((max_skill_len, embed_dim)) if dataset == "Assist09" else final_skill_embed[skill_id[line]]
-    if dataset == "Assist09":
-        for index in range(len(skill_id[line])):
-            tmp_skill_embed[index] = final_skill_embed[skill_id[line][index]]
-    else:
-        tmp_skill_embed = tmp_skill_embed.reshape(1, embed_dim)
-    tmp_pro_skill_embed = np.concatenate([tmp_pro_embed, tmp_skill_embed], 0)
-    tmp_stu_pro_skill = np.matmul(tmp_stu_embed, np.transpose(tmp_pro_skill_embed))
-    final_joint_embed[line] = tmp_stu_pro_skill
-print(final_joint_embed.shape)
-
-final_true_corr = np.array(true_corr)
-np.savez(os.path.join(modelfolder, 'final_true_corr.npz'), final_true_corr=final_true_corr)
-np.savez(os.path.join(modelfolder, 'final_joint_embed.npz'), final_joint_embed=final_joint_embed)
+modelfolder = os.path.join(dataset, model_dir)
+joint_file = os.path.join(modelfolder, 'final_joint_embed.npy')
+
+
+# skill ids of lines b to e padded to max_skill_len, and mask of positions that hold a real skill
+def pad_line_skills(skill_offsets, skill_indices, b, e, max_skill_len):
+    offsets = skill_offsets[b:e + 1]
+    mask = np.arange(max_skill_len) < (offsets[1:] - offsets[:-1]).reshape(-1, 1)
+    padded = np.zeros((e - b, max_skill_len), dtype=np.int64)
+    padded[mask] = skill_indices[offsets[0]:offsets[-1]]
+    return padded, mask
+
+
+"""
+joint embedding of lines = inner products of student embedding with problem embedding and with each skill embedding,
+padding positions are 0
+"""
+def joint_embedding(stu_embed, pro_embed, skill_embed, stu_id, pro_id, padded_skills, mask):
+    pro_skill_embed = np.concatenate([pro_embed[pro_id][:, None, :], skill_embed[padded_skills]], 1)
+    joint = np.einsum('cd,ckd->ck', stu_embed[stu_id], pro_skill_embed)
+    joint[:, 1:][~mask] = 0
+    return joint
+
+
+# embeddings, lines and output file are opened once in each process
+inputs = {}
+
+
+def load_inputs():
+    stu_pro_skill_corr = load_npz_mmap(os.path.join(datafolder, "stu_pro_skill_corr.npz"))
+    for key in ['stu', 'pro', 'skill_offsets', 'skill_indices']:
+        inputs[key] = stu_pro_skill_corr[key]
+    for key in ['pro', 'skill', 'stu']:
+        inputs[key + '_embed'] = load_array(modelfolder, "final_%s_embed" % key)
+    inputs['joint'] = np.load(joint_file, mmap_mode='r+')
+
+
+# build joint embeddings of lines b to e and write them into output file
+def build_chunk(b, e):
+    padded_skills, mask = pad_line_skills(inputs['skill_offsets'], inputs['skill_indices'], b, e, inputs['joint'].shape[1] - 1)
+    inputs['joint'][b:e] = joint_embedding(inputs['stu_embed'], inputs['pro_embed'], inputs['skill_embed'],
+                                           inputs['stu'][b:e], inputs['pro'][b:e], padded_skills, mask)
+    inputs['joint'].flush()
+    return e - b
+
+
+if __name__ == '__main__':
+    max_skill_len = load_manifest(datafolder)['max_skill_len']
+    true_corr = load_npz_mmap(os.path.join(datafolder, "stu_pro_skill_corr.npz"))["correct"]
+    data_num = len(true_corr)
+    # output is written chunk by chunk, so only one chunk of lines is held in memory by each process
+    final_joint_embed = np.lib.format.open_memmap(joint_file, mode='w+', dtype=np.float32, shape=(data_num, 1 + max_skill_len))
+    del final_joint_embed
+    chunks = [(b, min(b + joint_chunk, data_num)) for b in range(0, data_num, joint_chunk)]
+    with record_stage('joint_embedding', data_num):
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=load_inputs) as executor:
+                list(executor.map(build_chunk, [b for b, e in chunks], [e for b, e in chunks]))
+        else:
+            load_inputs()
+            for b, e in chunks:
+                build_chunk(b, e)
+    print((data_num, 1 + max_skill_len))
+
+    save_array(modelfolder, 'final_true_corr', true_corr)
@@ -0,0 +1,38 @@
+import numpy as np
+
+"""
+Streaming evaluation of test predictions:
+predictions are added batch by batch into histograms of predicted probabilities of positive and negative labels,
+so memory does not grow with the size of test set and nothing has to be sorted.
+AUC is computed from the histograms, predictions falling into the same bucket count as ties,
+so the error shrinks as the number of buckets grows.
+"""
+
+
+def new_evaluator(num_buckets):
+    return {'pos': np.zeros(num_buckets, dtype=np.int64), 'neg': np.zeros(num_buckets, dtype=np.int64), 'correct': 0, 'total': 0}
+
+
+# add a batch of logits and 0/1 labels, a prediction is correct when logits >= 0.5 agrees with the label
+def update_evaluator(evaluator, logits, labels):
+    num_buckets = len(evaluator['pos'])
+    probs = 1. / (1. + np.exp(-np.asarray(logits, dtype=np.float64)))
+    buckets = np.minimum((probs * num_buckets).astype(np.int64), num_buckets - 1)
+    positive = np.asarray(labels) > 0.5
+    evaluator['pos'] += np.bincount(buckets[positive], minlength=num_buckets)
+    evaluator['neg'] += np.bincount(buckets[~positive], minlength=num_buckets)
+    evaluator['correct'] += int(np.sum((np.asarray(logits) >= 0.5) == positive))
+    evaluator['total'] += len(positive)
+
+
+# probability that a random positive is ranked above a random negative, ties count half
+def evaluator_auc(evaluator):
+    pos, neg = evaluator['pos'].astype(np.float64), evaluator['neg'].astype(np.float64)
+    if pos.sum() == 0 or neg.sum() == 0:
+        return float('nan')
+    neg_below = np.cumsum(neg) - neg
+    return float(np.sum(pos * (neg_below + 0.5 * neg)) / (pos.sum() * neg.sum()))
+
+
+def evaluator_acc(evaluator):
+    return evaluator['correct'] / max(evaluator['total'], 1)
@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import HyperParameter
+from ProcessData import *
+from Telemetry import record_stage
+
+"""
+Runs the whole workflow (ProcessData.py ---> TrainEmbedding.py ---> JointEmbedding.py ---> TrainModel.py ---> Recommend.py)
+as a dependency graph of stages.
+Each stage is keyed by the hash of its code, its input files and the values of the hyperparameters it uses,
+a stage is only rerun when its key changes or one of its outputs is missing,
+e.g. changing lr only reruns the training stages.
+"""
+codefolder = os.path.dirname(os.path.abspath(__file__))
+# keys of finished stages and cached file hashes are kept here
+stampfolder = '.pipeline'
+
+
+# hash file content, hashes are cached by file size and modification time to avoid re-reading large files
+def file_hash(path, cache):
+    stat = os.stat(path)
+    cached = cache.get(path)
+    if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+        return cached['hash']
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    cache[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': h.hexdigest()}
+    return cache[path]['hash']
+
+
+# stages in topological order, inputs of each stage are outputs of earlier stages or original dataset
+def pipeline_stages(dataset):
+    datafolder, modelfolder = os.path.join(dataset, 'Data'), os.path.join(dataset, HyperParameter.model_dir)
+    data = lambda *names: [os.path.join(datafolder, name) for name in names]
+    model = lambda *names: [os.path.join(modelfolder, name) for name in names]
+    cleaned = data(dataset + '.csv')
+    embeds = model('final_pro_embed.npy', 'final_skill_embed.npy', 'final_stu_embed.npy')
+    stages = [
+        {'name': 'clean', 'code': ['ProcessData.py'], 'params': ['dataset'],
+         'inputs': data(dataset + '_original.csv'), 'outputs': cleaned,
+         'run': lambda ctx: run_clean(dataset)},
+        {'name': 'ids', 'code': ['ProcessData.py', 'ArtifactStore.py'], 'params': ['dataset', 'incremental'],
+         'inputs': cleaned, 'outputs': data('problems.npy', 'problems_sorter.npy', 'students.npy', 'students_sorter.npy', 'manifest.json',
+                                            'pro_count.npy', 'stu_count.npy', 'delta_pro.npy', 'delta_stu.npy'),
+         'run': lambda ctx: extract_pro_stu_id(dataset, 'Data', *load_index(ctx, dataset))},
+        {'name': 'pro_skill', 'code': ['ProcessData.py', 'ArtifactStore.py'], 'params': ['dataset', 'incremental'],
+         'inputs': cleaned, 'outputs': data('skills.npy', 'skills_sorter.npy', 'pro_skill_offsets.npy', 'pro_skill_indices.npy', 'pro_skill_sparse.npz', 'manifest.json'),
+         'run': lambda ctx: extract_pro_skill(dataset, 'Data', *load_index(ctx, dataset))},
+        {'name': 'pro_diff', 'code': ['ProcessData.py'], 'params': ['dataset', 'incremental'],
+         'inputs': cleaned, 'outputs': data('pro_diff_sparse.npz'),
+         'run': lambda ctx: extract_pro_diff(dataset, 'Data', *load_index(ctx, dataset))},
+        {'name': 'stu_skill', 'code': ['ProcessData.py'], 'params': ['dataset', 'incremental'],
+         'inputs': cleaned, 'outputs': data('skill_diff_sparse.npz', 'stu_skill_sparse.npz'),
+         'run': lambda ctx: extract_stu_skill(dataset, 'Data', *load_index(ctx, dataset))},
+        {'name': 'correlation', 'code': ['ProcessData.py'], 'params': ['top_k', 'min_simi'],
+         'inputs': data('pro_skill_sparse.npz'), 'outputs': data('pro_pro_sparse.npz', 'skill_skill_sparse.npz'),
+         'run': lambda ctx: extract_pro_skill_correlation(dataset, 'Data', HyperParameter.top_k, HyperParameter.min_simi)},
+        {'name': 'interactions', 'code': ['ProcessData.py'], 'params': ['dataset', 'incremental'],
+         'inputs': cleaned, 'outputs': data('stu_pro_skill_corr.npz'),
+         'run': lambda ctx: extract_stu_pro_skill_corr(dataset, 'Data', *load_index(ctx, dataset))},
+        {'name': 'embedding', 'code': ['TrainEmbedding.py', 'ArtifactStore.py'], 'params': ['epochs', 'bs', 'early_stop', 'lr', 'embed_dim', 'pro_pro_loss', 'num_neg', 'stu_skill_loss', 'incremental', 'converge_tol'],
+         'inputs': data('pro_skill_sparse.npz', 'pro_pro_sparse.npz', 'skill_skill_sparse.npz', 'pro_diff_sparse.npz', 'skill_diff_sparse.npz', 'stu_skill_sparse.npz',
+                        'delta_pro.npy', 'delta_stu.npy'),
+         'outputs': embeds,
+         'run': lambda ctx: run_script('TrainEmbedding.py')},
+    ]
+    predict = {'name': 'predict', 'code': ['TrainModel.py', 'JointEmbedding.py', 'ArtifactStore.py', 'Metrics.py'],
+               'params': ['epochs', 'bs', 'early_stop', 'keep_rate', 'split_rate', 'lr', 'joint_mode', 'shuffle_batches', 'auc_buckets', 'exact_auc'],
+               'outputs': model('trainModel.txt', 'pred_w.npy', 'pred_b.npy'), 'run': lambda ctx: run_script('TrainModel.py')}
+    if HyperParameter.joint_mode == "fused":
+        # joint embeddings are computed inside TrainModel.py
+        predict['inputs'] = data('stu_pro_skill_corr.npz') + embeds
+    else:
+        stages.append({'name': 'joint', 'code': ['JointEmbedding.py', 'ArtifactStore.py'], 'params': [],
+                       'inputs': data('stu_pro_skill_corr.npz') + embeds,
+                       'outputs': model('final_joint_embed.npy', 'final_true_corr.npy'),
+                       'run': lambda ctx: run_script('JointEmbedding.py')})
+        predict['inputs'] = model('final_joint_embed.npy', 'final_true_corr.npy')
+    index = {'name': 'index', 'code': ['Recommend.py', 'JointEmbedding.py', 'ArtifactStore.py'], 'params': ['ivf_lists'],
+             'inputs': embeds + model('pred_w.npy', 'pred_b.npy') + data('pro_skill_offsets.npy', 'pro_skill_indices.npy'),
+             'outputs': model(*['%s_%s.npy' % (name, key) for name in ['pro_index', 'skill_index', 'score_index']
+                                for key in ['centroids', 'offsets', 'ids', 'vectors']]),
+             'run': lambda ctx: run_script('Recommend.py')}
+    return stages + [predict, index]
+
+
+def run_clean(dataset):
+    pre_file, post_file = dataset + "_original.csv", dataset + ".csv"
+    if HyperParameter.chunk_size:
+        process_data_chunked(dataset, 'Data', pre_file, post_file, data_cols, HyperParameter.chunk_size)
+    else:
+        process_data(dataset, 'Data', pre_file, post_file, data_cols)
+
+
+# cleaned dataset and its factorized index are loaded once and shared by all stages of a run
+def load_index(ctx, dataset):
+    if 'index' not in ctx:
+        ctx['df'] = read_data(dataset, 'Data', dataset + '.csv', data_cols)
+        ctx['index'] = factorize_data(dataset, ctx['df'])
+    return ctx['df'], ctx['index']
+
+
+def run_script(script):
+    subprocess.run([sys.executable, os.path.join(codefolder, script)], check=True)
+
+
+# key of a stage = hash of its name, code, hyperparameters and input files
+def stage_key(stage, cache):
+    h = hashlib.sha256(stage['name'].encode())
+    for code in stage['code']:
+        h.update(file_hash(os.path.join(codefolder, code), cache).encode())
+    for param in stage['params']:
+        h.update(('%s=%r' % (param, getattr(HyperParameter, param))).encode())
+    for path in stage['inputs']:
+        h.update(file_hash(path, cache).encode())
+    return h.hexdigest()
+
+
+def run_pipeline(dataset, until=None, force=(), dry_run=False):
+    stamps = os.path.join(dataset, stampfolder)
+    os.makedirs(stamps, exist_ok=True)
+    cache_file = os.path.join(stamps, 'file_hashes.json')
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    ctx = {}
+    for stage in pipeline_stages(dataset):
+        missing = [path for path in stage['inputs'] if not os.path.exists(path)]
+        if missing:
+            if dry_run:
+                print("stage %s: would run (inputs not built yet)" % stage['name'])
+                continue
+            raise FileNotFoundError("stage %s is missing inputs %s" % (stage['name'], missing))
+        key = stage_key(stage, cache)
+        stamp_file = os.path.join(stamps, stage['name'] + '.json')
+        old_key = None
+        if os.path.exists(stamp_file):
+            with open(stamp_file, 'r') as f:
+                old_key = json.load(f)['key']
+        outputs_exist = all(os.path.exists(path) for path in stage['outputs'])
+        if key == old_key and outputs_exist and stage['name'] not in force:
+            print("stage %s: up to date" % stage['name'])
+        elif dry_run:
+            print("stage %s: would run" % stage['name'])
+        else:
+            print("stage %s: running" % stage['name'])
+            starttime = time.time()
+            with record_stage('pipeline_' + stage['name']):
+                stage['run'](ctx)
+            with open(stamp_file, 'w') as f:
+                json.dump({'key': key, 'time': time.time() - starttime}, f)
+        if stage['name'] == until:
+            break
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run PCKT stages whose code, inputs or hyperparameters changed')
+    parser.add_argument('--until', help='stop after this stage')
+    parser.add_argument('--force', nargs='*', default=[], help='rerun these stages even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    args = parser.parse_args()
+    run_pipeline(dataset, args.until, args.force, args.dry_run)
@@ -1,340 +1,436 @@
 import os
-import time
 import pandas as pd
 import numpy as np
 from scipy import sparse
-from collections import defaultdict
 from HyperParameter import *
+from concurrent.futures import ProcessPoolExecutor
+from Telemetry import record_stage
+from ArtifactStore import save_vocab, save_csr, save_manifest, save_array, load_array, load_manifest, load_vocab, load_csr, lookup_ids
 
+# columns of original dataset used by the model
+data_cols = ["user_id", "problem_id", "skill_id", "correct", "ms_first_response"]
 
-# delete abnormal answer time
+
+# delete abnormal answer time, works element-wise on arrays and series
 def clean_abnormal(num, mean, std):
     min_normal = mean - 2 * std
     max_normal = mean + 2 * std
-    if num > max_normal or num < min_normal:
-        return 1
-    return 0
-
-
-# calculate correlation
-def correlation(set1, set2):
-    union = set(set1).union(set(set2))
-    intersection = set(set1).intersection(set(set2))
-    return (len(intersection) / len(union))
+    return (num > max_normal) | (num < min_normal)
 
 
-# save data file
-def save_dict(dict_name, file_name):
-    with open(file_name, 'w') as f:
-        f.write(str(dict_name))
+# calculate correlation (jaccard similarity) between every two rows of a sparse 0-1 matrix
+def correlation(adj, top_k=0, min_simi=0., block_size=4096):
+    adj = (adj.tocsr() > 0).astype(np.float64)
+    num_row = adj.shape[0]
+    if num_row == 0:
+        return sparse.csr_matrix((0, 0))
+    # size of set of each row
+    degree = np.asarray(adj.sum(1)).ravel()
+    adj_t = adj.T.tocsc()
+    rows, cols, simis = [], [], []
+    # rows are processed block by block so that the intersection matrix never has to be held completely
+    for b in range(0, num_row, block_size):
+        # size of intersection of two rows
+        inter = (adj[b:b + block_size] @ adj_t).tocoo()
+        row, col = inter.row + b, inter.col
+        # size of union = size of set1 + size of set2 - size of intersection
+        simi = inter.data / (degree[row] + degree[col] - inter.data)
+        keep = simi >= min_simi
+        row, col, simi = row[keep], col[keep], simi[keep]
+        if top_k:
+            # keep top_k most similar columns of each row
+            order = np.lexsort((-simi, row))
+            row, col, simi = row[order], col[order], simi[order]
+            row_start = np.searchsorted(row, row)
+            keep = np.arange(len(row)) - row_start < top_k
+            row, col, simi = row[keep], col[keep], simi[keep]
+        rows.append(row)
+        cols.append(col)
+        simis.append(simi)
+    rows, cols, simis = np.concatenate(rows), np.concatenate(cols), np.concatenate(simis)
+    return sparse.csr_matrix((simis, (rows, cols)), shape=(num_row, num_row))
 
 
 # clean up dataset
 def process_data(dataset, datafolder, pre_file, post_file, cols):
-    starttime = time.time()
-    # read dataset
-    df = pd.read_csv(os.path.join(dataset, datafolder, pre_file), encoding='ISO-8859-1', low_memory=False)
-    # remove abnormal skills
-    df = df.dropna(subset=['skill_id'])
-    # remove all scaffolding problems
-    df = df[df['original'].isin([1])]
-    # delete abnormal answer time
-    df = df.dropna(subset=['ms_first_response'])
-    df = df[df["ms_first_response"] > 0]
-    # student group
-    students = df.groupby(['user_id'], as_index=True)
-    # delete all answer records of students with less than 5 answers
-    delete_students = []
-    for student in students:
-        if len(student[1]) < 5:
-            delete_students.append(student[0])
-    df = df[~df['user_id'].isin(delete_students)]
-    # extract column information
-    df = df[cols]
-    # extract all problem
-    problems = df['problem_id'].unique()
-    delete_lines = []
-    for pro_id in range(len(problems)):
-        # extract all records of each problem
-        tmp_df = df[df['problem_id'] == problems[pro_id]]
-        # extract line number
-        tmp_lines = tmp_df.index
-        # calculate mean and standard deviation
-        mean_ms, std_ms = tmp_df["ms_first_response"].mean(), tmp_df["ms_first_response"].std()
-        for line in tmp_lines:
-            # extract answer time of each line
-            tmp_ms = tmp_df[tmp_df.index == line]["ms_first_response"].values
-            # judging whether it is an abnormal answering time
-            if (clean_abnormal(tmp_ms, mean_ms, std_ms)):
-                delete_lines.append(line)
-    # delete record where abnormal data is located
-    df = df[~df.index.isin(delete_lines)]
-    # answer time changed from milliseconds to seconds
-    df["ms_first_response"] /= 1000
-    df.to_csv(os.path.join(dataset, datafolder, post_file))
-    endtime = time.time()
-    print("process_data time:", endtime - starttime)
+    with record_stage('process_data') as record:
+        # read dataset
+        df = pd.read_csv(os.path.join(dataset, datafolder, pre_file), encoding='ISO-8859-1', low_memory=False)
+        record['rows'] = len(df)
+        # remove abnormal skills
+        df = df.dropna(subset=['skill_id'])
+        # remove all scaffolding problems
+        df = df[df['original'].isin([1])]
+        # delete abnormal answer time
+        df = df.dropna(subset=['ms_first_response'])
+        df = df[df["ms_first_response"] > 0]
+        # delete all answer records of students with less than 5 answers
+        stu_count = df.groupby('user_id')['user_id'].transform('size')
+        df = df[stu_count >= 5]
+        # extract column information
+        df = df[cols]
+        # calculate mean and standard deviation of answer time of each problem
+        pro_ms = df.groupby('problem_id')["ms_first_response"]
+        mean_ms, std_ms = pro_ms.transform('mean'), pro_ms.transform('std')
+        # delete record where abnormal answering time is located
+        df = df[~clean_abnormal(df["ms_first_response"], mean_ms, std_ms)]
+        # answer time changed from milliseconds to seconds
+        df["ms_first_response"] /= 1000
+        df.to_csv(os.path.join(dataset, datafolder, post_file))
+
+
+# narrow column types used when original dataset is read chunk by chunk
+def chunk_dtypes(dataset):
+    return {'user_id': np.int32, 'problem_id': np.int32, 'correct': np.int8, 'original': np.int8,
+            'ms_first_response': np.float64, 'skill_id': str if dataset == "Assist09" else np.float64}
+
+
+# read original dataset chunk by chunk, keep records of non-scaffolding problems with normal skill and answer time
+def read_chunks(dataset, datafolder, pre_file, cols, chunk_size):
+    usecols = list(cols) + ['original']
+    chunks = pd.read_csv(os.path.join(dataset, datafolder, pre_file), encoding='ISO-8859-1', usecols=usecols,
+                         dtype=chunk_dtypes(dataset), chunksize=chunk_size)
+    for chunk in chunks:
+        chunk = chunk.dropna(subset=['skill_id', 'ms_first_response'])
+        yield chunk[(chunk['original'] == 1) & (chunk["ms_first_response"] > 0)][cols]
+
+
+# clean up dataset with bounded memory, the result is the same as process_data
+def process_data_chunked(dataset, datafolder, pre_file, post_file, cols, chunk_size):
+    with record_stage('process_data_chunked') as record:
+        """1. count answer records of each student"""
+        stu_count = pd.Series(dtype=np.int64)
+        for chunk in read_chunks(dataset, datafolder, pre_file, cols, chunk_size):
+            stu_count = stu_count.add(chunk['user_id'].value_counts(), fill_value=0)
+        # students with at least 5 answers
+        keep_students = stu_count.index[stu_count >= 5]
+        record['rows'] = stu_count.sum()
+        """
+        2. calculate mean and standard deviation of answer time of each problem,
+        statistics of each chunk are merged into running count, mean and sum of squared deviations (Welford / Chan)
+        """
+        pro_stat = pd.DataFrame(columns=['n', 'mean', 'm2'], dtype=np.float64)
+        for chunk in read_chunks(dataset, datafolder, pre_file, cols, chunk_size):
+            chunk = chunk[chunk['user_id'].isin(keep_students)]
+            chunk_ms = chunk.groupby('problem_id')["ms_first_response"]
+            chunk_stat = pd.DataFrame({'n': chunk_ms.size().astype(np.float64), 'mean': chunk_ms.mean()})
+            chunk_stat['m2'] = chunk_ms.var(ddof=0) * chunk_stat['n']
+            index = pro_stat.index.union(chunk_stat.index)
+            old, new = pro_stat.reindex(index, fill_value=0.), chunk_stat.reindex(index, fill_value=0.)
+            n = old['n'] + new['n']
+            delta = new['mean'] - old['mean']
+            pro_stat = pd.DataFrame({'n': n,
+                                     'mean': old['mean'] + delta * new['n'] / n,
+                                     'm2': old['m2'] + new['m2'] + delta ** 2 * old['n'] * new['n'] / n})
+        # sample standard deviation, same as pandas std
+        pro_stat['std'] = np.sqrt(pro_stat['m2'] / (pro_stat['n'] - 1)).where(pro_stat['n'] > 1)
+        """3. delete abnormal records and write cleaned dataset chunk by chunk"""
+        post_path = os.path.join(dataset, datafolder, post_file)
+        header = True
+        for chunk in read_chunks(dataset, datafolder, pre_file, cols, chunk_size):
+            chunk = chunk[chunk['user_id'].isin(keep_students)]
+            mean_ms, std_ms = chunk['problem_id'].map(pro_stat['mean']), chunk['problem_id'].map(pro_stat['std'])
+            chunk = chunk[~clean_abnormal(chunk["ms_first_response"], mean_ms, std_ms)]
+            # answer time changed from milliseconds to seconds
+            chunk["ms_first_response"] /= 1000
+            chunk.to_csv(post_path, mode='w' if header else 'a', header=header)
+            header = False
+
+
+# read cleaned dataset
+def read_data(dataset, datafolder, post_file, cols):
+    return pd.read_csv(os.path.join(dataset, datafolder, post_file), encoding="ISO-8859-1", usecols=cols, dtype=chunk_dtypes(dataset))
+
+
+# positions starts[i] to starts[i] + lengths[i] - 1 of all i, concatenated
+def concat_ranges(starts, lengths):
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+# number values in order of first appearance, values of previous (vocab, sorter) keep their ids and new values are numbered after them
+def stable_factorize(values, previous=None):
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques)
+    if previous is None:
+        return codes, uniques
+    vocab, sorter = previous
+    ids = lookup_ids(vocab, sorter, uniques)
+    new = ids < 0
+    # a value must only get the id of an equal value, e.g. skill '151' must not be taken for '15'
+    if np.asarray(vocab)[ids[~new]].tolist() != uniques[~new].tolist():
+        raise ValueError("values were matched to different values of the previous vocabulary")
+    ids[new] = len(vocab) + np.arange(new.sum())
+    return ids[codes], np.concatenate([np.asarray(vocab), uniques[new]])
+
+
+# factorize problems, students and skills once, shared by all extraction stages
+def factorize_data(dataset, df):
+    # in incremental mode ids of the previous run are kept, so that previous embeddings stay valid
+    folder, previous = os.path.join(dataset, 'Data'), {}
+    if incremental:
+        for name in ['problems', 'students', 'skills']:
+            if os.path.exists(os.path.join(folder, name + '.npy')):
+                previous[name] = load_vocab(folder, name, mmap_mode=None)
+    # problem and student id of each line, numbered in order of first appearance
+    pro, problems = stable_factorize(df['problem_id'], previous.get('problems'))
+    stu, students = stable_factorize(df['user_id'], previous.get('students'))
+    # skills of each problem are taken from its first record
+    first = np.flatnonzero(~df['problem_id'].duplicated().values)
+    first_skills = df['skill_id'].iloc[first]
+    if dataset == "Assist09":
+        pro_skills = [ele.split('_') for ele in first_skills]
+    else:
+        pro_skills = [[ele] for ele in first_skills.tolist()]
+    skill_len = np.array([len(ele) for ele in pro_skills], dtype=np.int64)
+    # skill id is numbered in the order in which skills appear over problems
+    skill_indices, skills = stable_factorize(pd.Series([ele for tmp_skills in pro_skills for ele in tmp_skills], dtype=object), previous.get('skills'))
+    row_ids = np.asarray(pro)[first]
+    if 'problems' in previous:
+        # previous problems without records in this dataset keep their previous skills
+        prev_offsets, prev_indices = load_csr(folder, 'pro_skill', mmap_mode=None)
+        missing = np.setdiff1d(np.arange(len(prev_offsets) - 1), row_ids)
+        prev_len = (prev_offsets[1:] - prev_offsets[:-1])[missing]
+        row_ids = np.concatenate([row_ids, missing])
+        skill_indices = np.concatenate([skill_indices, prev_indices[concat_ranges(prev_offsets[missing], prev_len)]])
+        skill_len = np.concatenate([skill_len, prev_len])
+    # skill lists in order of problem id
+    order = np.argsort(row_ids, kind='stable')
+    skill_indices = skill_indices[concat_ranges((np.cumsum(skill_len) - skill_len)[order], skill_len[order])]
+    skill_len = skill_len[order]
+    # problem-skill relationships in CSR form: skills of problem i are indices[offsets[i]:offsets[i + 1]]
+    skill_offsets = np.concatenate([[0], np.cumsum(skill_len)])
+    return {'pro': pro.astype(np.int32),
+            'stu': stu.astype(np.int32),
+            'correct': (df['correct'].values == 1).astype(np.int8),
+            'ms': df['ms_first_response'].values.astype(np.float64),
+            'problems': np.asarray(problems),
+            'students': np.asarray(students),
+            'skills': list(skills),
+            'pro_skill_offsets': skill_offsets,
+            'pro_skill_indices': skill_indices.astype(np.int32),
+            'num_pro': len(problems),
+            'num_stu': len(students),
+            'num_skill': len(skills),
+            'max_skill_len': int(skill_len.max()) if len(skill_len) else 0}
+
+
+# expand each line into one entry per skill of its problem, return line index and skill id of every entry
+def expand_line_skills(index):
+    offsets, indices, pro = index['pro_skill_offsets'], index['pro_skill_indices'], index['pro']
+    line_len = (offsets[1:] - offsets[:-1])[pro]
+    lines = np.repeat(np.arange(len(pro)), line_len)
+    # position of each entry inside skill list of its line
+    inner = np.arange(len(lines)) - np.repeat(np.cumsum(line_len) - line_len, line_len)
+    return lines, indices[np.repeat(offsets[pro], line_len) + inner]
+
+
+# save factorized index as .npy columns, worker processes open them memory-mapped instead of receiving pickled copies
+def save_index(folder, index):
+    os.makedirs(folder, exist_ok=True)
+    for key, value in index.items():
+        if isinstance(value, int):
+            save_manifest(folder, **{key: value})
+        else:
+            value = np.asarray(value)
+            save_array(folder, key, value.astype(str) if value.dtype == object else value)
+
+
+def load_index(folder):
+    index = load_manifest(folder)
+    for key in ['pro', 'stu', 'correct', 'ms', 'problems', 'students', 'skills', 'pro_skill_offsets', 'pro_skill_indices']:
+        index[key] = load_array(folder, key)
+    return index
+
+
+# run one extraction stage in a worker process on the memory-mapped index, the stage records its own telemetry
+def run_stage(stage, dataset, datafolder, index_folder):
+    if stage == 'pro_skill_correlation':
+        extract_pro_skill_correlation(dataset, datafolder, top_k, min_simi)
+    else:
+        index = load_index(index_folder)
+        {'pro_diff': extract_pro_diff,
+         'stu_skill': extract_stu_skill,
+         'stu_pro_skill_corr': extract_stu_pro_skill_corr}[stage](dataset, datafolder, None, index)
+    return stage
+
+
+# stages after extract_pro_skill are independent of each other, run them on a process pool
+def extract_parallel(dataset, datafolder, index, workers):
+    with record_stage('extract_parallel', len(index['pro'])):
+        index_folder = os.path.join(dataset, datafolder, 'index')
+        save_index(index_folder, index)
+        stages = ['stu_pro_skill_corr', 'stu_skill', 'pro_diff', 'pro_skill_correlation']
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_stage, stage, dataset, datafolder, index_folder) for stage in stages]
+            for future in futures:
+                future.result()
 
 
 # extract problems and students and their corresponding id
-def extract_pro_stu_id(dataset, datafolder, df):
-    starttime = time.time()
-    # extract all problems and students
-    problems, students = df['problem_id'].unique(), df['user_id'].unique()
-    # extract total number of problems and students
-    num_pro, num_stu = len(problems), len(students)
-    # add problems and students corresponding id
-    pro_id_dict, stu_id_dict = dict(zip(problems, range(num_pro))), dict(zip(students, range(num_stu)))
-    save_dict(list(problems), os.path.join(dataset, datafolder, 'problems.txt'))
-    save_dict(list(students), os.path.join(dataset, datafolder, 'students.txt'))
-    save_dict(num_pro, os.path.join(dataset, datafolder, 'num_pro.txt'))
-    save_dict(num_stu, os.path.join(dataset, datafolder, 'num_stu.txt'))
-    save_dict(pro_id_dict, os.path.join(dataset, datafolder, 'pro_id_dict.txt'))
-    save_dict(stu_id_dict, os.path.join(dataset, datafolder, 'stu_id_dict.txt'))
-    endtime = time.time()
-    print("extract_pro_stu_id time:", endtime - starttime)
+def extract_pro_stu_id(dataset, datafolder, df, index=None):
+    with record_stage('extract_pro_stu_id') as record:
+        if index is None:
+            index = factorize_data(dataset, df)
+        record['rows'] = len(index['pro'])
+        # all problems and students, id of problems[i] (students[i]) is i
+        save_vocab(os.path.join(dataset, datafolder), 'problems', index['problems'])
+        save_vocab(os.path.join(dataset, datafolder), 'students', index['students'])
+        # total number of problems and students
+        save_manifest(os.path.join(dataset, datafolder), num_pro=index['num_pro'], num_stu=index['num_stu'])
+        # problems and students whose number of records changed since the previous run, retrained in incremental mode
+        for name, num in [('pro', index['num_pro']), ('stu', index['num_stu'])]:
+            count = np.bincount(index[name], minlength=num)
+            previous = np.zeros(num, dtype=count.dtype)
+            if os.path.exists(os.path.join(dataset, datafolder, name + '_count.npy')):
+                previous_count = load_array(os.path.join(dataset, datafolder), name + '_count', mmap_mode=None)[:num]
+                previous[:len(previous_count)] = previous_count
+            save_array(os.path.join(dataset, datafolder), 'delta_' + name, np.flatnonzero(count != previous).astype(np.int32))
+            save_array(os.path.join(dataset, datafolder), name + '_count', count)
 
 
 # extract problem-skill relationships
-def extract_pro_skill(dataset, datafolder, df):
-    starttime = time.time()
-    with open(os.path.join(dataset, datafolder, 'num_pro.txt'), 'r') as f:
-        num_pro = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'problems.txt'), 'r') as f:
-        problems = eval(f.read())
-    pro_skill_adj, skill_id_dict, pro_skill_dict = [], {}, defaultdict(list)
-    count_skill, max_skill_len = 0, 0
-    for pro_id in range(num_pro):
-        # extract all records of each problem
-        tmp_df = df[df['problem_id'] == problems[pro_id]]
-        # extract skills corresponding to each problem
-        tmp_skills = [ele for ele in tmp_df.iloc[0]['skill_id'].split('_')] if dataset == "Assist09" else tmp_df.iloc[0]['skill_id']
-        # add skill id
-        if dataset == "Assist09":
-            max_skill_len = max(len(tmp_skills), max_skill_len)
-            for skill in tmp_skills:
-                if skill not in skill_id_dict:
-                    skill_id_dict[skill] = count_skill
-                    count_skill += 1
-                # add problem-skill relationship, represented by 0 or 1
-                pro_skill_adj.append([pro_id, skill_id_dict[skill], 1])
-                pro_skill_dict[pro_id].append(skill_id_dict[skill])
-        else:
-            if tmp_skills not in skill_id_dict:
-                skill_id_dict[tmp_skills] = count_skill
-                count_skill += 1
-            pro_skill_adj.append([pro_id, skill_id_dict[tmp_skills], 1])
-            pro_skill_dict[pro_id] = skill_id_dict[tmp_skills]
-    # extract total number of skills
-    num_skill = len(skill_id_dict)
-    if dataset == "Assist09":
-        save_dict(max_skill_len, os.path.join(dataset, datafolder, 'max_skill_len.txt'))
-    save_dict(num_skill, os.path.join(dataset, datafolder, 'num_skill.txt'))
-    save_dict(skill_id_dict, os.path.join(dataset, datafolder, 'skill_id_dict.txt'))
-    save_dict(dict(pro_skill_dict), os.path.join(dataset, datafolder, 'pro_skill_dict.txt'))
-    pro_skill_adj = np.array(pro_skill_adj).astype(np.int32)
-    pro_skill_sparse = sparse.coo_matrix((pro_skill_adj[:, 2].astype(np.float32), (pro_skill_adj[:, 0], pro_skill_adj[:, 1])), shape=(num_pro, num_skill))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'pro_skill_sparse.npz'), pro_skill_sparse)
-    endtime = time.time()
-    print("extract_pro_skill time:", endtime - starttime)
+def extract_pro_skill(dataset, datafolder, df, index=None):
+    with record_stage('extract_pro_skill') as record:
+        if index is None:
+            index = factorize_data(dataset, df)
+        record['rows'] = len(index['pro'])
+        num_pro, num_skill = index['num_pro'], index['num_skill']
+        offsets, indices = index['pro_skill_offsets'], index['pro_skill_indices']
+        # all skills, and skills of each problem in CSR form
+        save_vocab(os.path.join(dataset, datafolder), 'skills', index['skills'])
+        save_csr(os.path.join(dataset, datafolder), 'pro_skill', offsets, indices)
+        save_manifest(os.path.join(dataset, datafolder), num_skill=num_skill, max_skill_len=index['max_skill_len'])
+        # add problem-skill relationship, represented by 0 or 1,
+        # sparse matrices are saved uncompressed so that their arrays can be opened memory-mapped,
+        # matrices TrainEmbedding.py reads by rows are saved in CSR form, so that they are used without conversion
+        pro_skill_rows = np.repeat(np.arange(num_pro), offsets[1:] - offsets[:-1])
+        pro_skill_sparse = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), (pro_skill_rows, indices)), shape=(num_pro, num_skill))
+        sparse.save_npz(os.path.join(dataset, datafolder, 'pro_skill_sparse.npz'), pro_skill_sparse, compressed=False)
 
 
 # extraction of problem difficulty
-def extract_pro_diff(dataset, datafolder, df):
-    starttime = time.time()
-    with open(os.path.join(dataset, datafolder, 'num_pro.txt'), 'r') as f:
-        num_pro = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'problems.txt'), 'r') as f:
-        problems = eval(f.read())
-    pro_diff_adj = []
-    for pro_id in range(num_pro):
-        # extract all records of each problem
-        tmp_df = df[df['problem_id'] == problems[pro_id]]
-        # extract all line records where each problem is answered correctly
-        tmp_df_corr = tmp_df[tmp_df["correct"] == 1]
+def extract_pro_diff(dataset, datafolder, df, index=None):
+    with record_stage('extract_pro_diff') as record:
+        if index is None:
+            index = factorize_data(dataset, df)
+        record['rows'] = len(index['pro'])
+        num_pro, pro, correct = index['num_pro'], index['pro'], index['correct']
+        # count all records and correctly answered records of each problem
+        num_pro_total = np.bincount(pro, minlength=num_pro)
+        num_pro_corr = np.bincount(pro, weights=correct, minlength=num_pro)
         # calculate average correct answer time for each problem,represents answer speed
-        tmp_time_pro_corr = 0
-        if len(tmp_df_corr):
-            tmp_time_pro_corr = tmp_df_corr["ms_first_response"].mean()
+        time_pro_corr = np.bincount(pro, weights=index['ms'] * correct, minlength=num_pro)
+        time_pro_corr = np.divide(time_pro_corr, num_pro_corr, out=np.zeros(num_pro), where=num_pro_corr > 0)
+        pro_diff_adj = np.zeros((num_pro, 3), dtype=np.float32)
         # calculate correct answer rate for each problem,represents answer accuracy
-        tmp_acc_pro_corr = len(tmp_df_corr) / len(tmp_df)
-        tmp_pro_diff_adj = [0.] * 3
-        tmp_pro_diff_adj[0], tmp_pro_diff_adj[1] = tmp_time_pro_corr, tmp_acc_pro_corr
-        pro_diff_adj.append(tmp_pro_diff_adj)
-    # normalization of answer speed
-    pro_diff_adj = np.array(pro_diff_adj).astype(np.float32)
-    pro_diff_adj[:, 0] = (pro_diff_adj[:, 0] - np.min(pro_diff_adj[:, 0])) / (np.max(pro_diff_adj[:, 0]) - np.min(pro_diff_adj[:, 0]))
-    # calculate problem difficulty = answer accuracy / answer speed
-    pro_diff_adj[:, 2] = pro_diff_adj[:, 1] / (pro_diff_adj[:, 0] + 1e-4)
-    # normalization of problem difficulty
-    pro_diff_adj[:, 2] = (pro_diff_adj[:, 2] - np.min(pro_diff_adj[:, 2])) / (np.max(pro_diff_adj[:, 2]) - np.min(pro_diff_adj[:, 2]))
-    pro_diff_list = pro_diff_adj[:, 2]
-    pro_diff_sparse = sparse.coo_matrix(pro_diff_list, shape=(1, num_pro))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'pro_diff_sparse.npz'), pro_diff_sparse)
-    endtime = time.time()
-    print("extract_pro_diff time:", endtime - starttime)
+        pro_diff_adj[:, 0] = time_pro_corr
+        pro_diff_adj[:, 1] = np.divide(num_pro_corr, num_pro_total, out=np.zeros(num_pro), where=num_pro_total > 0)
+        # normalization of answer speed
+        pro_diff_adj[:, 0] = (pro_diff_adj[:, 0] - np.min(pro_diff_adj[:, 0])) / (np.max(pro_diff_adj[:, 0]) - np.min(pro_diff_adj[:, 0]))
+        # calculate problem difficulty = answer accuracy / answer speed
+        pro_diff_adj[:, 2] = pro_diff_adj[:, 1] / (pro_diff_adj[:, 0] + 1e-4)
+        # normalization of problem difficulty
+        pro_diff_adj[:, 2] = (pro_diff_adj[:, 2] - np.min(pro_diff_adj[:, 2])) / (np.max(pro_diff_adj[:, 2]) - np.min(pro_diff_adj[:, 2]))
+        pro_diff_list = pro_diff_adj[:, 2]
+        pro_diff_sparse = sparse.coo_matrix(pro_diff_list, shape=(1, num_pro))
+        sparse.save_npz(os.path.join(dataset, datafolder, 'pro_diff_sparse.npz'), pro_diff_sparse, compressed=False)
 
 
 # extract student-skill relationship
-def extract_stu_skill(dataset, datafolder, df):
-    starttime = time.time()
-    with open(os.path.join(dataset, datafolder, 'problems.txt'), 'r') as f:
-        problems = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'num_pro.txt'), 'r') as f:
-        num_pro = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'num_stu.txt'), 'r') as f:
-        num_stu = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'num_skill.txt'), 'r') as f:
-        num_skill = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'stu_id_dict.txt'), 'r') as f:
-        stu_id_dict = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'skill_id_dict.txt'), 'r') as f:
-        skill_id_dict = eval(f.read())
-    stu_skill_total_adj, stu_skill_corr_adj, stu_skill_adj = np.zeros((num_stu, num_skill)), np.zeros((num_stu, num_skill)), np.zeros((num_stu, num_skill))
-    for pro_id in range(num_pro):
-        tmp_df = df[df['problem_id'] == problems[pro_id]]
-        tmp_skills = [ele for ele in tmp_df.iloc[0]['skill_id'].split('_')] if dataset == "Assist09" else tmp_df.iloc[0]['skill_id']
-        # extract line index
-        tmp_lines = tmp_df.index
-        for line in tmp_lines:
-            # extract student and corresponding id of each line
-            tmp_stu = int(tmp_df[tmp_df.index == line]["user_id"].values)
-            tmp_stu_id = stu_id_dict[tmp_stu]
-            if dataset == "Assist09":
-                """
-                If student answers problem correctly, 
-                it is considered that student correctly answers skills corresponding to this problem
-                """
-                if tmp_df[tmp_df.index == line]["correct"].values == 1:
-                    for skill in tmp_skills:
-                        stu_skill_corr_adj[tmp_stu_id][skill_id_dict[skill]] += 1
-                        """
-                        Regardless of whether student answer problem correctly or not,
-                        number of times the student answer skills corresponding to this problem will be increased by 1
-                        """
-                        stu_skill_total_adj[tmp_stu_id][skill_id_dict[skill]] += 1
-                else:
-                    for skill in tmp_skills:
-                        stu_skill_total_adj[tmp_stu_id][skill_id_dict[skill]] += 1
-            else:
-                if tmp_df[tmp_df.index == line]["correct"].values == 1:
-                    stu_skill_corr_adj[tmp_stu_id][skill_id_dict[tmp_skills]] += 1
-                    stu_skill_total_adj[tmp_stu_id][skill_id_dict[tmp_skills]] += 1
-                else:
-                    stu_skill_total_adj[tmp_stu_id][skill_id_dict[tmp_skills]] += 1
-    # calculate total number of times skills were answered
-    skill_total_list = np.sum(stu_skill_total_adj, 0)
-    # calculate total number of times skills were answered correctly
-    skill_corr_list = np.sum(stu_skill_corr_adj, 0)
-    # calculate skill difficulty = total number of correct answers / total number of answers
-    skill_diff_list = np.zeros(num_skill)
-    for i in range(num_skill):
-        if skill_total_list[i]:
-            skill_diff_list[i] = skill_corr_list[i] / skill_total_list[i]
-    """
-    calculate  degree of students' mastery of skills = 
-    number of times students answer correctly for skills / number of times students answer skills
-    """
-    for i in range(num_stu):
-        for j in range(num_skill):
-            if stu_skill_total_adj[i][j]:
-                stu_skill_adj[i][j] = stu_skill_corr_adj[i][j] / stu_skill_total_adj[i][j]
-    skill_diff_sparse = sparse.coo_matrix(skill_diff_list, shape=(1, num_skill))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'skill_diff_sparse.npz'), skill_diff_sparse)
-    stu_skill_sparse = sparse.coo_matrix(stu_skill_adj, shape=(num_stu, num_skill))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'stu_skill_sparse.npz'), stu_skill_sparse)
-    endtime = time.time()
-    print("extract_stu_skill time:", endtime - starttime)
+def extract_stu_skill(dataset, datafolder, df, index=None):
+    with record_stage('extract_stu_skill') as record:
+        if index is None:
+            index = factorize_data(dataset, df)
+        record['rows'] = len(index['pro'])
+        num_stu, num_skill = index['num_stu'], index['num_skill']
+        """
+        Each record counts once for every skill of its problem:
+        the number of times the student answers these skills is increased by 1,
+        and if the student answers the problem correctly, the number of correct answers is increased by 1 as well
+        """
+        lines, line_skills = expand_line_skills(index)
+        # only (student, skill) pairs that were answered at least once are kept
+        stu_skill_pair, pair_inverse = np.unique(index['stu'][lines].astype(np.int64) * num_skill + line_skills, return_inverse=True)
+        pair_stu, pair_skill = stu_skill_pair // num_skill, stu_skill_pair % num_skill
+        stu_skill_total_list = np.bincount(pair_inverse).astype(np.float64)
+        stu_skill_corr_list = np.bincount(pair_inverse, weights=index['correct'][lines])
+        # calculate total number of times skills were answered
+        skill_total_list = np.bincount(pair_skill, weights=stu_skill_total_list, minlength=num_skill)
+        # calculate total number of times skills were answered correctly
+        skill_corr_list = np.bincount(pair_skill, weights=stu_skill_corr_list, minlength=num_skill)
+        # calculate skill difficulty = total number of correct answers / total number of answers
+        skill_diff_list = np.divide(skill_corr_list, skill_total_list, out=np.zeros(num_skill), where=skill_total_list > 0)
+        """
+        calculate  degree of students' mastery of skills = 
+        number of times students answer correctly for skills / number of times students answer skills
+        only answered pairs are stored, so a stored zero means the student never answered the skill correctly
+        """
+        stu_skill_list = stu_skill_corr_list / stu_skill_total_list
+        skill_diff_sparse = sparse.coo_matrix(skill_diff_list, shape=(1, num_skill))
+        sparse.save_npz(os.path.join(dataset, datafolder, 'skill_diff_sparse.npz'), skill_diff_sparse, compressed=False)
+        stu_skill_sparse = sparse.csr_matrix((stu_skill_list, (pair_stu, pair_skill)), shape=(num_stu, num_skill))
+        sparse.save_npz(os.path.join(dataset, datafolder, 'stu_skill_sparse.npz'), stu_skill_sparse, compressed=False)
 
 
 # extract problem-problem, skill-skill relationships
-def extract_pro_skill_correlation(dataset, datafolder):
-    starttime = time.time()
-    pro_skill_coo = sparse.load_npz(os.path.join(dataset, datafolder, "pro_skill_sparse.npz"))
-    [num_pro, num_skill] = pro_skill_coo.toarray().shape
-    pro_skill_csc = pro_skill_coo.tocsc()
-    pro_skill_csr = pro_skill_coo.tocsr()
-    """1. extract problem-problem relationships"""
-    pro_pro_adj, temp_pro_pro_simi = [], []
-    for pro_index in range(num_pro):
-        # extract skills corresponding to problem
-        tmp_skills = pro_skill_csr.getrow(pro_index).indices
-        # extract problems set with same skills as this problem
-        similar_pros = pro_skill_csc[:, tmp_skills].indices
-        # remove duplicate elements of problems set
-        similar_pros = list(set(similar_pros))
-        # save problem-problem relationship element position
-        zipped = zip([pro_index] * len(similar_pros), similar_pros)
-        pro_pro_adj += list(zipped)
-        for pro in similar_pros:
-            # extract the skills corresponding to each problem in problems set
-            tmp_pro_skills = pro_skill_csr.getrow(pro).indices
-            # calculate similarity
-            temp_pro_pro_simi.append(correlation(tmp_skills, tmp_pro_skills))
-    pro_pro_adj = np.array(pro_pro_adj).astype(np.int32)
-    pro_pro_sparse = sparse.coo_matrix((temp_pro_pro_simi, (pro_pro_adj[:, 0], pro_pro_adj[:, 1])), shape=(num_pro, num_pro))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'pro_pro_sparse.npz'), pro_pro_sparse)
-    """2. extract skill-skill relationships"""
-    skill_skill_adj, temp_skill_skill_simi = [], []
-    for skill_index in range(num_skill):
-        tmp_pros = pro_skill_csc.getcol(skill_index).indices
-        similar_skills = pro_skill_csr[tmp_pros, :].indices
-        similar_skills = list(set(similar_skills))
-        zipped = zip([skill_index] * len(similar_skills), similar_skills)
-        skill_skill_adj += list(zipped)
-        for skill in similar_skills:
-            tmp_skill_pros = pro_skill_csc.getcol(skill).indices
-            temp_skill_skill_simi.append(correlation(tmp_pros, tmp_skill_pros))
-    skill_skill_adj = np.array(skill_skill_adj).astype(np.int32)
-    skill_skill_sparse = sparse.coo_matrix((temp_skill_skill_simi, (skill_skill_adj[:, 0], skill_skill_adj[:, 1])), shape=(num_skill, num_skill))
-    sparse.save_npz(os.path.join(dataset, datafolder, 'skill_skill_sparse.npz'), skill_skill_sparse)
-    endtime = time.time()
-    print("extract_pro_skill_correlation time:", endtime - starttime)
-
-
-"""
-extract each line record's students, problems, skills and answers, and convert them into corresponding id for storage  
-If dataset is Assist12, this part may take 7 hours to 8 hours to complete
-"""
-def extract_stu_pro_skill_corr(dataset, datafolder, df):
-    starttime = time.time()
-    with open(os.path.join(dataset, datafolder, 'pro_id_dict.txt'), 'r') as f:
-        pro_id_dict = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'pro_skill_dict.txt'), 'r') as f:
-        pro_skill_dict = eval(f.read())
-    with open(os.path.join(dataset, datafolder, 'stu_id_dict.txt'), 'r') as f:
-        stu_id_dict = eval(f.read())
-    df1 = df[["user_id", "problem_id", "skill_id", "correct"]]
-    df1["problem_id"] = df1["problem_id"].map(lambda pro: pro_id_dict[pro])
-    df1["skill_id"] = df1["problem_id"].map(lambda pro: pro_skill_dict[pro])
-    df1["user_id"] = df1["user_id"].map(lambda stu: stu_id_dict[stu])
-
-    stu_pro_skill_corr = []
-    for line in df1.index:
-        tmp_stu = int(df1[df1.index == line]["user_id"].values)
-        tmp_pro = int(df1[df1.index == line]["problem_id"].values)
-        tmp_skill = df1[df1.index == line]["skill_id"].values.tolist().pop(0)
-        tmp_corr = int(df1[df1.index == line]["correct"].values)
-        tmp_stu_pro_skill_corr = [tmp_stu, tmp_pro, tmp_skill, tmp_corr]
-        stu_pro_skill_corr.append(tmp_stu_pro_skill_corr)
-    np.savez(os.path.join(dataset, datafolder, 'stu_pro_skill_corr.npz'), stu_pro_skill_corr=stu_pro_skill_corr)
-    endtime = time.time()
-    print("extract_stu_pro_skill_corr time:", endtime - starttime)
+def extract_pro_skill_correlation(dataset, datafolder, top_k=0, min_simi=0.):
+    with record_stage('extract_pro_skill_correlation') as record:
+        pro_skill_coo = sparse.load_npz(os.path.join(dataset, datafolder, "pro_skill_sparse.npz"))
+        record['rows'] = pro_skill_coo.shape[0]
+        """
+        1. extract problem-problem relationships, 
+        two problems are related if they share skills, similarity is computed over their skill sets
+        """
+        pro_pro_sparse = correlation(pro_skill_coo, top_k, min_simi)
+        sparse.save_npz(os.path.join(dataset, datafolder, 'pro_pro_sparse.npz'), pro_pro_sparse, compressed=False)
+        """
+        2. extract skill-skill relationships, 
+        two skills are related if they share problems, similarity is computed over their problem sets
+        """
+        skill_skill_sparse = correlation(pro_skill_coo.T, top_k, min_simi)
+        sparse.save_npz(os.path.join(dataset, datafolder, 'skill_skill_sparse.npz'), skill_skill_sparse, compressed=False)
+
+
+# extract each line record's students, problems, skills and answers, and convert them into corresponding id for storage
+def extract_stu_pro_skill_corr(dataset, datafolder, df, index=None):
+    with record_stage('extract_stu_pro_skill_corr') as record:
+        if index is None:
+            index = factorize_data(dataset, df)
+        record['rows'] = len(index['pro'])
+        """
+        each line is stored column by column, 
+        skills of line i are skill_indices[skill_offsets[i]:skill_offsets[i + 1]]
+        """
+        lines, line_skills = expand_line_skills(index)
+        skill_offsets = np.searchsorted(lines, np.arange(len(index['pro']) + 1)).astype(np.int64)
+        np.savez(os.path.join(dataset, datafolder, 'stu_pro_skill_corr.npz'),
+                 stu=index['stu'].astype(np.int32),
+                 pro=index['pro'].astype(np.int32),
+                 correct=index['correct'].astype(np.int32),
+                 skill_offsets=skill_offsets,
+                 skill_indices=line_skills.astype(np.int32))
 
 
 if __name__ == '__main__':
-    starttime = time.time()
     datafolder = "Data"
     pre_file = dataset + "_original.csv"
     post_file = dataset + ".csv"
-    cols = ["user_id", "problem_id", "skill_id", "correct", "ms_first_response"]
-    process_data(dataset, datafolder, pre_file, post_file, cols)
-    df = pd.read_csv(os.path.join(dataset, datafolder, post_file), encoding="ISO-8859-1", low_memory=True)
-    extract_pro_stu_id(dataset, datafolder, df)
-    extract_pro_skill(dataset, datafolder, df)
-    extract_pro_diff(dataset, datafolder, df)
-    extract_stu_skill(dataset, datafolder, df)
-    extract_pro_skill_correlation(dataset, datafolder)
-    extract_stu_pro_skill_corr(dataset, datafolder, df)
-    endtime = time.time()
-    print("total time :", endtime - starttime)
+    cols = data_cols
+    with record_stage('ProcessData') as total:
+        if chunk_size:
+            process_data_chunked(dataset, datafolder, pre_file, post_file, cols, chunk_size)
+        else:
+            process_data(dataset, datafolder, pre_file, post_file, cols)
+        with record_stage('factorize_data') as record:
+            df = read_data(dataset, datafolder, post_file, cols)
+            index = factorize_data(dataset, df)
+            record['rows'] = total['rows'] = len(df)
+        extract_pro_stu_id(dataset, datafolder, df, index)
+        extract_pro_skill(dataset, datafolder, df, index)
+        if num_workers > 1:
+            extract_parallel(dataset, datafolder, index, num_workers)
+        else:
+            extract_pro_diff(dataset, datafolder, df, index)
+            extract_stu_skill(dataset, datafolder, df, index)
+            extract_pro_skill_correlation(dataset, datafolder, top_k, min_simi)
+            extract_stu_pro_skill_corr(dataset, datafolder, df, index)
@@ -0,0 +1,200 @@
+import argparse
+import os
+import time
+import numpy as np
+from scipy import sparse
+from HyperParameter import *
+from ArtifactStore import load_manifest, load_array, save_array, load_vocab, load_csr, lookup_ids
+from JointEmbedding import pad_line_skills
+
+"""
+Problem recommendation with inverted-file (IVF) indexes over embeddings, saved next to the model:
+vectors are clustered by k-means, a query only scans the nprobe lists whose centroids score highest,
+more lists scanned means higher recall and slower queries.
+    pro_index    normalized problem embeddings, most similar problems by cosine similarity
+    skill_index  normalized skill embeddings, most similar skills by cosine similarity
+    score_index  problem vectors q_p with student embedding s . q_p + pred_b = logit of TrainModel.py,
+                 problems ranked by predicted success of a student, built when TrainModel.py has been run
+"""
+datafolder = os.path.join(dataset, 'Data')
+modelfolder = os.path.join(dataset, model_dir)
+
+
+def normalize(vectors):
+    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norm, 1e-12)
+
+
+# list of each vector = centroid with the highest inner product, computed block by block to bound memory
+def assign_lists(vectors, centroids, block_size=65536):
+    return np.concatenate([np.argmax(vectors[b:b + block_size].dot(centroids.T), axis=1) for b in range(0, len(vectors), block_size)])
+
+
+# spherical k-means on at most 256 sampled vectors per list, centroids are normalized
+def kmeans(vectors, num_lists, iters=10, seed=0):
+    rng = np.random.RandomState(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), 256 * num_lists), replace=False)]
+    centroids = normalize(sample[rng.choice(len(sample), num_lists, replace=False)])
+    for i in range(iters):
+        assign = assign_lists(sample, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=num_lists)
+        # empty lists keep their old centroid
+        filled = counts > 0
+        starts = (np.cumsum(counts) - counts)[filled]
+        centroids[filled] = normalize(np.add.reduceat(sample[order], starts, axis=0))
+    return centroids
+
+
+# vectors of each list are stored contiguously: list l holds ids[offsets[l]:offsets[l + 1]]
+def build_ivf(vectors, num_lists=0):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not num_lists:
+        num_lists = int(np.sqrt(len(vectors)))
+    num_lists = max(1, min(num_lists, len(vectors)))
+    centroids = kmeans(normalize(vectors), num_lists)
+    assign = assign_lists(vectors, centroids)
+    ids = np.argsort(assign, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(assign[ids], np.arange(num_lists + 1)).astype(np.int64)
+    return {'centroids': centroids, 'offsets': offsets, 'ids': ids, 'vectors': vectors[ids]}
+
+
+def save_ivf(folder, name, index):
+    for key, value in index.items():
+        save_array(folder, '%s_%s' % (name, key), value)
+
+
+def load_ivf(folder, name, mmap_mode='r'):
+    return {key: load_array(folder, '%s_%s' % (name, key), mmap_mode) for key in ['centroids', 'offsets', 'ids', 'vectors']}
+
+
+# k highest scores and their ids
+def top_scores(ids, scores, k):
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[part], scores[part]
+    order = np.argsort(-scores, kind='stable')
+    return ids[order], scores[order]
+
+
+# rows of index holding the vectors of lists
+def list_rows(index, lists):
+    return np.concatenate([np.arange(index['offsets'][l], index['offsets'][l + 1]) for l in lists])
+
+
+# k vectors of index with the highest inner products with query,
+# allowed is an optional boolean mask over ids of vectors that may be returned
+def search_ivf(index, query, k, nprobe, allowed=None):
+    lists = np.argsort(-index['centroids'].dot(query), kind='stable')
+    nprobe = min(nprobe, len(lists))
+    rows = list_rows(index, lists[:nprobe])
+    if allowed is not None:
+        rows = rows[allowed[index['ids'][rows]]]
+        # the nprobe lists may hold fewer than k allowed vectors, further lists are scanned in order of centroid score
+        while len(rows) < k and nprobe < len(lists):
+            more = list_rows(index, lists[nprobe:nprobe + 1])
+            rows = np.concatenate([rows, more[allowed[index['ids'][more]]]])
+            nprobe += 1
+    return top_scores(index['ids'][rows], index['vectors'][rows].dot(query), k)
+
+
+def exact_search(vectors, query, k, allowed=None):
+    ids = np.arange(len(vectors)) if allowed is None else np.flatnonzero(allowed)
+    return top_scores(ids, vectors[ids].dot(query), k)
+
+
+"""
+logit of TrainModel.py = pred_w[0] * s.p + sum_k pred_w[k] * s.skill_k + pred_b, with skill_k the k-th skill of problem p,
+so it equals s.q_p + pred_b with q_p = pred_w[0] * p + sum_k pred_w[k] * skill_k
+"""
+def score_vectors(pro_embed, skill_embed, pred_w):
+    manifest = load_manifest(datafolder)
+    offsets, indices = load_csr(datafolder, 'pro_skill')
+    padded_skills, mask = pad_line_skills(offsets, indices, 0, manifest['num_pro'], manifest['max_skill_len'])
+    skill_weights = pred_w[0, 1:] * mask
+    return pred_w[0, 0] * pro_embed + np.einsum('ck,ckd->cd', skill_weights, skill_embed[padded_skills])
+
+
+def build_indexes():
+    starttime = time.time()
+    pro_embed = load_array(modelfolder, 'final_pro_embed', mmap_mode=None)
+    skill_embed = load_array(modelfolder, 'final_skill_embed', mmap_mode=None)
+    save_ivf(modelfolder, 'pro_index', build_ivf(normalize(pro_embed), ivf_lists))
+    save_ivf(modelfolder, 'skill_index', build_ivf(normalize(skill_embed), ivf_lists))
+    if os.path.exists(os.path.join(modelfolder, 'pred_w.npy')):
+        pred_w = load_array(modelfolder, 'pred_w', mmap_mode=None)
+        save_ivf(modelfolder, 'score_index', build_ivf(score_vectors(pro_embed, skill_embed, pred_w), ivf_lists))
+    print("build_indexes time:", time.time() - starttime)
+
+
+# k problems most similar to problem with original id problem_id
+def similar_problems(problem_id, k, nprobe):
+    problems, sorter = load_vocab(datafolder, 'problems')
+    pro = lookup_ids(problems, sorter, [problem_id])[0]
+    if pro < 0:
+        raise KeyError("unknown problem %s" % problem_id)
+    index = load_ivf(modelfolder, 'pro_index')
+    # the problem itself is not recommended
+    ids, scores = search_ivf(index, normalize(load_array(modelfolder, 'final_pro_embed')[[pro]])[0], k + 1, nprobe)
+    keep = ids != pro
+    return problems[ids[keep][:k]], scores[keep][:k]
+
+
+# k problems with difficulty in [min_diff, max_diff] that student with original id student_id most likely answers correctly
+def recommend_problems(student_id, k, nprobe, min_diff=0., max_diff=1.):
+    students, sorter = load_vocab(datafolder, 'students')
+    stu = lookup_ids(students, sorter, [student_id])[0]
+    if stu < 0:
+        raise KeyError("unknown student %s" % student_id)
+    pro_diff = sparse.load_npz(os.path.join(datafolder, 'pro_diff_sparse.npz')).toarray()[0]
+    allowed = (pro_diff >= min_diff) & (pro_diff <= max_diff)
+    index = load_ivf(modelfolder, 'score_index')
+    ids, scores = search_ivf(index, np.array(load_array(modelfolder, 'final_stu_embed')[stu]), k, nprobe, allowed)
+    probs = 1. / (1. + np.exp(-(scores + load_array(modelfolder, 'pred_b')[0, 0])))
+    return load_array(datafolder, 'problems')[ids], probs
+
+
+# recall of top-k results and queries per second of each nprobe compared with exact search
+def benchmark(name, queries, k, nprobes):
+    index = load_ivf(modelfolder, name, mmap_mode=None)
+    vectors = index['vectors'][np.argsort(index['ids'])]
+    starttime = time.time()
+    exact = [set(exact_search(vectors, query, k)[0]) for query in queries]
+    print("%s exact: %.1f queries/s" % (name, len(queries) / (time.time() - starttime)))
+    for nprobe in nprobes:
+        starttime = time.time()
+        found = [search_ivf(index, query, k, nprobe)[0] for query in queries]
+        speed = len(queries) / (time.time() - starttime)
+        recall = np.mean([len(exact_set.intersection(ids)) / float(len(exact_set)) for exact_set, ids in zip(exact, found)])
+        print("%s nprobe %d: recall@%d %.4f, %.1f queries/s" % (name, nprobe, k, recall, speed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build and query problem recommendation indexes')
+    parser.add_argument('action', nargs='?', default='build', choices=['build', 'similar', 'recommend', 'benchmark'])
+    parser.add_argument('--problem', help='original problem_id for similar')
+    parser.add_argument('--student', help='original user_id for recommend')
+    parser.add_argument('--min-diff', type=float, default=0.)
+    parser.add_argument('--max-diff', type=float, default=1.)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, default=nprobe)
+    parser.add_argument('--queries', type=int, default=1000, help='number of random queries for benchmark')
+    args = parser.parse_args()
+    if args.action == 'build':
+        build_indexes()
+    elif args.action == 'similar':
+        for problem, score in zip(*similar_problems(args.problem, args.k, args.nprobe)):
+            print(problem, score)
+    elif args.action == 'recommend':
+        for problem, prob in zip(*recommend_problems(args.student, args.k, args.nprobe, args.min_diff, args.max_diff)):
+            print(problem, prob)
+    else:
+        rng = np.random.RandomState(0)
+        nprobes = [1, 2, 4, 8, 16, 32, 64]
+        pro_embed = load_array(modelfolder, 'final_pro_embed')
+        benchmark('pro_index', normalize(pro_embed[rng.randint(len(pro_embed), size=args.queries)]), args.k, nprobes)
+        skill_embed = load_array(modelfolder, 'final_skill_embed')
+        benchmark('skill_index', normalize(skill_embed[rng.randint(len(skill_embed), size=args.queries)]), args.k, nprobes)
+        if os.path.exists(os.path.join(modelfolder, 'score_index_ids.npy')):
+            stu_embed = load_array(modelfolder, 'final_stu_embed')
+            benchmark('score_index', np.array(stu_embed[np.sort(rng.randint(len(stu_embed), size=args.queries))]), args.k, nprobes)
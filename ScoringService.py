@@ -0,0 +1,263 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from HyperParameter import *
+from ArtifactStore import load_manifest, load_array, load_vocab, load_csr, lookup_ids
+from JointEmbedding import pad_line_skills, joint_embedding
+from FoldIn import load_fold_in, fold_in, append_students
+
+"""
+Local HTTP service scoring the probability that a student answers a problem correctly,
+with the embeddings of TrainEmbedding.py and the prediction weights of TrainModel.py.
+    POST /score {"student": S, "problem": P} or {"pairs": [[S, P], ...]}  ->  {"probs": [...]}
+    GET /score?student=S&problem=P
+    GET /stats  ->  latency percentiles, batch sizes and student cache hits
+    POST /fold_in {"records": [[S, P, correct], ...]}  ->  adds embeddings of new students S from their records (see FoldIn.py)
+S and P are the original user_id and problem_id as integers, the probability of an unknown student or problem is null.
+Pairs of concurrent requests are scored together in one batch by a single worker thread.
+"""
+datafolder = os.path.join(dataset, 'Data')
+modelfolder = os.path.join(dataset, model_dir)
+# number of latest requests used for latency percentiles
+latency_window = 10000
+
+model = {}
+stats = {'requests': 0, 'pairs': 0, 'batches': 0, 'cache_hits': 0, 'cache_misses': 0, 'latency': collections.deque(maxlen=latency_window)}
+stats_lock = threading.Lock()
+# requests waiting to be scored, each is a dict of student ids, problem ids and an event set when probs are filled
+pending = queue.Queue()
+# fold-in requests append to the embedding files one at a time
+fold_lock = threading.Lock()
+
+
+def load_model():
+    manifest = load_manifest(datafolder)
+    model['students'], model['students_sorter'] = load_vocab(datafolder, 'students', mmap_mode=None)
+    model['problems'], model['problems_sorter'] = load_vocab(datafolder, 'problems', mmap_mode=None)
+    # skills of every problem are padded once, skills of a pair are the skills of its problem
+    offsets, indices = load_csr(datafolder, 'pro_skill')
+    model['pro_skills'], model['pro_mask'] = pad_line_skills(offsets, indices, 0, manifest['num_pro'], manifest['max_skill_len'])
+    model['pro_embed'] = load_array(modelfolder, 'final_pro_embed', mmap_mode=None)
+    model['skill_embed'] = load_array(modelfolder, 'final_skill_embed', mmap_mode=None)
+    # student embeddings stay memory-mapped, recently used students are kept in memory
+    model['stu_embed'] = load_array(modelfolder, 'final_stu_embed')
+    model['stu_cache'] = collections.OrderedDict()
+    model['pred_w'] = load_array(modelfolder, 'pred_w', mmap_mode=None)
+    model['pred_b'] = load_array(modelfolder, 'pred_b', mmap_mode=None)
+    model['fold'] = load_fold_in()
+
+
+# embeddings of students, only called by the batch worker, so the cache needs no lock
+def student_vectors(stu_ids):
+    cache, hits = model['stu_cache'], 0
+    vectors = np.empty((len(stu_ids), model['stu_embed'].shape[1]), dtype=model['stu_embed'].dtype)
+    for k, stu in enumerate(stu_ids):
+        vector = cache.get(stu)
+        if vector is None:
+            vector = cache[stu] = np.array(model['stu_embed'][stu])
+            if len(cache) > stu_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(stu)
+            hits += 1
+        vectors[k] = vector
+    with stats_lock:
+        stats['cache_hits'] += hits
+        stats['cache_misses'] += len(stu_ids) - hits
+    return vectors
+
+
+# probabilities of pairs of student ids and problem ids, joint embeddings are built as in JointEmbedding.py
+def score(stu_ids, pro_ids):
+    students, stu_rows = np.unique(stu_ids, return_inverse=True)
+    joint = joint_embedding(student_vectors(students), model['pro_embed'], model['skill_embed'], stu_rows, pro_ids,
+                            model['pro_skills'][pro_ids], model['pro_mask'][pro_ids])
+    logits = joint.dot(model['pred_w'].T) + model['pred_b']
+    return 1. / (1. + np.exp(-logits.reshape(-1)))
+
+
+# collect requests arriving within serve_wait_ms (up to serve_batch pairs) and score them together
+def batch_worker():
+    while True:
+        batch = [pending.get()]
+        size = len(batch[0]['stu'])
+        deadline = time.time() + serve_wait_ms / 1000.
+        while size < serve_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+            size += len(batch[-1]['stu'])
+        try:
+            probs = score(np.concatenate([item['stu'] for item in batch]), np.concatenate([item['pro'] for item in batch]))
+            splits = np.cumsum([len(item['stu']) for item in batch])[:-1]
+            for item, item_probs in zip(batch, np.split(probs, splits)):
+                item['probs'] = item_probs
+        except Exception as err:
+            for item in batch:
+                item['error'] = err
+        with stats_lock:
+            stats['batches'] += 1
+            stats['pairs'] += size
+        for item in batch:
+            item['done'].set()
+
+
+# original ids are integers, given as JSON numbers or as strings in query strings, anything else raises ValueError
+def parse_ids(values):
+    ids = []
+    for value in values:
+        if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError("id %r is not an integer" % (value,))
+        ids.append(value)
+    return ids
+
+
+# list of [student, problem] or [student, problem, correct] lists of a request body
+def parse_records(records, length):
+    if not isinstance(records, list) or not all(isinstance(record, list) and len(record) == length for record in records):
+        raise ValueError("expected a list of lists of length %d" % length)
+    return records
+
+
+# probabilities of (student, problem) pairs given by original ids, None for unknown ids, including ids out of range of the vocabulary
+def score_pairs(pairs):
+    pairs = parse_records(pairs, 2)
+    students = lookup_ids(model['students'], model['students_sorter'], parse_ids([pair[0] for pair in pairs]))
+    problems = lookup_ids(model['problems'], model['problems_sorter'], parse_ids([pair[1] for pair in pairs]))
+    known = (students >= 0) & (problems >= 0)
+    probs = [None] * len(pairs)
+    if known.any():
+        item = {'stu': students[known], 'pro': problems[known], 'done': threading.Event()}
+        pending.put(item)
+        item['done'].wait()
+        if 'error' in item:
+            raise item['error']
+        for k, prob in zip(np.flatnonzero(known), item['probs']):
+            probs[k] = float(prob)
+    return probs
+
+
+# add embeddings of new students from records (user_id, problem_id, correct), they can be scored right after
+def fold_in_students(records):
+    records = parse_records(records, 3)
+    user_ids, problem_ids = parse_ids([record[0] for record in records]), parse_ids([record[1] for record in records])
+    # new students are added to the vocabulary, so their ids must fit into it
+    if any(not -2 ** 63 <= stu < 2 ** 63 for stu in user_ids):
+        raise ValueError("student id out of range")
+    correct = [record[2] for record in records]
+    if any(isinstance(value, bool) or value not in [0, 1] for value in correct):
+        raise ValueError("correct must be 0 or 1")
+    with fold_lock:
+        students, embeds = fold_in(model['fold'], user_ids, problem_ids, correct)
+        ids, new = append_students(students, embeds)
+        # embeddings are replaced before the vocabulary, so every id found in the vocabulary has a row
+        model['stu_embed'] = load_array(modelfolder, 'final_stu_embed')
+        model['students'], model['students_sorter'] = load_vocab(datafolder, 'students', mmap_mode=None)
+    return {'students': students.tolist(), 'new': new.tolist()}
+
+
+def latency_stats():
+    with stats_lock:
+        latency = np.array(stats['latency']) * 1000
+        result = {key: value for key, value in stats.items() if key != 'latency'}
+    result['p50_ms'] = float(np.percentile(latency, 50)) if len(latency) else None
+    result['p99_ms'] = float(np.percentile(latency, 99)) if len(latency) else None
+    result['mean_batch'] = result['pairs'] / max(result['batches'], 1)
+    return result
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.reply(200, latency_stats())
+        elif url.path == '/score':
+            query = parse_qs(url.query)
+            self.handle_score({'student': query.get('student', [None])[0], 'problem': query.get('problem', [None])[0]})
+        else:
+            self.reply(404, {'error': 'unknown path %s' % url.path})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in ['/score', '/fold_in']:
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as err:
+            self.reply(400, {'error': 'invalid json: %s' % err})
+            return
+        if not isinstance(body, dict):
+            self.reply(400, {'error': 'expected a json object'})
+            return
+        if path == '/fold_in':
+            self.handle_fold_in(body)
+        else:
+            self.handle_score(body)
+
+    def handle_fold_in(self, body):
+        if 'records' not in body:
+            self.reply(400, {'error': 'expected "records"'})
+            return
+        try:
+            self.reply(200, fold_in_students(body['records']))
+        except (ValueError, TypeError, IndexError) as err:
+            self.reply(400, {'error': str(err)})
+
+    def handle_score(self, body):
+        starttime = time.time()
+        if 'pairs' in body:
+            pairs = body['pairs']
+        elif body.get('student') is not None and body.get('problem') is not None:
+            pairs = [[body['student'], body['problem']]]
+        else:
+            self.reply(400, {'error': 'expected "pairs" or "student" and "problem"'})
+            return
+        try:
+            probs = score_pairs(pairs)
+        except (ValueError, TypeError, IndexError) as err:
+            self.reply(400, {'error': str(err)})
+            return
+        self.reply(200, {'probs': probs})
+        with stats_lock:
+            stats['requests'] += 1
+            stats['latency'].append(time.time() - starttime)
+
+    def reply(self, code, result):
+        content = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # requests are not logged one by one, see /stats
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve probabilities of students answering problems correctly')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=serve_port)
+    args = parser.parse_args()
+    load_model()
+    threading.Thread(target=batch_worker, daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), ScoringHandler)
+    print("serving %s on http://%s:%d" % (dataset, args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,100 @@
+import argparse
+import ast
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import HyperParameter
+
+"""
+Grid search over values of HyperParameter.py, e.g.
+    python Sweep.py --grid lr=0.01,0.001 embed_dim=128,512 --jobs 4
+Every configuration is a job running TrainEmbedding.py and then TrainModel.py with its own model folder <dataset>/Sweep/<job>,
+values are passed to the programs by environment variables PCKT_<name> (see the end of HyperParameter.py).
+Jobs run at the same time, each with bounded numbers of TensorFlow and BLAS threads.
+TrainModel.py computes joint embeddings batch by batch (joint_mode "fused"), so jobs only read the preprocessed files of ProcessData.py,
+which are opened memory-mapped and shared in page cache by all jobs.
+Results of all jobs are collected into one table <dataset>/Sweep/results.csv
+"""
+codefolder = os.path.dirname(os.path.abspath(__file__))
+sweep_dir = 'Sweep'
+# environment variables bounding threads of numpy's BLAS library
+blas_threads = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+# parse name=value1,value2,... into (name, [values]), values are python literals or plain strings
+def parse_grid(items):
+    grid = []
+    for item in items:
+        name, values = item.split('=', 1)
+        if not hasattr(HyperParameter, name):
+            raise KeyError("%s is not defined in HyperParameter.py" % name)
+        parsed = []
+        for value in values.split(','):
+            try:
+                parsed.append(ast.literal_eval(value))
+            except (ValueError, SyntaxError):
+                parsed.append(value)
+        grid.append((name, parsed))
+    return grid
+
+
+def job_name(config):
+    return '_'.join('%s-%s' % (name, value) for name, value in config.items()) or 'default'
+
+
+# run TrainEmbedding.py and TrainModel.py of one configuration, return configuration with results of TrainModel.py
+def run_job(config, threads, inter_threads):
+    dataset = config.get('dataset', HyperParameter.dataset)
+    model_dir = os.path.join(sweep_dir, job_name(config))
+    modelfolder = os.path.join(dataset, model_dir)
+    os.makedirs(modelfolder, exist_ok=True)
+    env = dict(os.environ)
+    env.update(('PCKT_' + name, repr(value)) for name, value in config.items())
+    env.update({'PCKT_model_dir': repr(model_dir), 'PCKT_joint_mode': repr('fused'),
+                'PCKT_telemetry_file': repr(os.path.join(model_dir, 'telemetry.jsonl')),
+                'PCKT_intra_threads': str(threads), 'PCKT_inter_threads': str(inter_threads)})
+    env.update((name, str(threads)) for name in blas_threads)
+    starttime = time.time()
+    returncode = 0
+    with open(os.path.join(modelfolder, 'sweep.log'), 'w') as log:
+        for script in ['TrainEmbedding.py', 'TrainModel.py']:
+            returncode = subprocess.run([sys.executable, os.path.join(codefolder, script)], env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+            if returncode != 0:
+                break
+    result = dict(config, job=model_dir, returncode=returncode, wall=time.time() - starttime)
+    if returncode == 0:
+        with open(os.path.join(modelfolder, 'results.json'), 'r') as f:
+            result.update(json.load(f))
+    print("job %s finished with exit code %d in %.1fs" % (model_dir, returncode, result['wall']))
+    return result
+
+
+def run_sweep(grid, jobs, threads, inter_threads):
+    names = [name for name, values in grid]
+    configs = [dict(zip(names, values)) for values in itertools.product(*[values for name, values in grid])]
+    print("running %d configurations, %d at a time" % (len(configs), jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda config: run_job(config, threads, inter_threads), configs))
+    table = pd.DataFrame(results)
+    if 'best_auc' in table:
+        table = table.sort_values('best_auc', ascending=False)
+    for dataset in sorted(set(config.get('dataset', HyperParameter.dataset) for config in configs)):
+        table.to_csv(os.path.join(dataset, sweep_dir, 'results.csv'), index=False)
+    print(table.to_string(index=False))
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a grid of PCKT configurations concurrently')
+    parser.add_argument('--grid', nargs='+', default=[], help='name=value1,value2,... for values of HyperParameter.py')
+    parser.add_argument('--jobs', type=int, default=2, help='number of configurations run at the same time')
+    parser.add_argument('--threads', type=int, help='intra-op threads of each job, default is cores divided by jobs')
+    parser.add_argument('--inter-threads', type=int, default=2, help='inter-op threads of each job')
+    args = parser.parse_args()
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.jobs)
+    run_sweep(parse_grid(args.grid), args.jobs, threads, args.inter_threads)
@@ -0,0 +1,89 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import resource
+import time
+import HyperParameter
+
+"""
+Performance records of stages and training epochs, appended as one JSON object per line to <dataset>/<telemetry_file>:
+    stage records: wall time, CPU time, peak resident memory, its growth during the stage and rows per second of a stage
+    epoch records: the same for a training epoch, with samples per second and time spent on feeding, computing and evaluating
+CPU time and peak memory include finished child processes, e.g. workers of ProcessData.py or scripts run by Pipeline.py.
+The stage named by profile_stage runs under cProfile, its statistics are saved to <dataset>/profile_<stage>.prof.
+"""
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def emit(kind, name, **fields):
+    record = {'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'kind': kind, 'name': name,
+              'dataset': HyperParameter.dataset, 'pid': os.getpid()}
+    record.update(fields)
+    if HyperParameter.telemetry_file:
+        path = os.path.join(HyperParameter.dataset, HyperParameter.telemetry_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return record
+
+
+def save_profile(name, profiler):
+    path = os.path.join(HyperParameter.dataset, 'profile_%s.prof' % name)
+    profiler.dump_stats(path)
+    print("profile of %s saved to %s" % (name, path))
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
+"""
+record a stage:
+    with record_stage('extract_pro_diff', rows) as record:
+        ...
+rows can also be set later with record['rows'] = rows, other keys of record are added to the emitted record,
+a stage that raises is recorded as well, with status "error" and the exception
+"""
+@contextlib.contextmanager
+def record_stage(name, rows=None):
+    record = {'rows': rows}
+    profiler = cProfile.Profile() if name == HyperParameter.profile_stage else None
+    starttime, startcpu, startrss = time.time(), cpu_time(), peak_rss_mb()
+    if profiler:
+        profiler.enable()
+    status = {'status': 'ok'}
+    try:
+        yield record
+    except BaseException as err:
+        status = {'status': 'error', 'error': '%s: %s' % (type(err).__name__, err)}
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            save_profile(name, profiler)
+        wall = time.time() - starttime
+        fields = {'wall': wall, 'cpu': cpu_time() - startcpu, 'peak_rss_mb': peak_rss_mb()}
+        fields['peak_rss_delta_mb'] = fields['peak_rss_mb'] - startrss
+        if record['rows'] is not None:
+            fields['rows'] = int(record['rows'])
+            fields['rows_per_sec'] = fields['rows'] / max(wall, 1e-9)
+        fields.update((key, value) for key, value in record.items() if key != 'rows')
+        fields.update(status)
+        emit('stage', name, **fields)
+        print("%s time:" % name, wall)
+
+
+# feed is time spent preparing batches (in background when batches are prefetched), compute is time of training steps,
+# evaluate is time of evaluating the model after the epoch
+def record_epoch(name, epoch, wall, cpu, samples, feed=None, compute=None, evaluate=None, **fields):
+    return emit('epoch', name, epoch=epoch, wall=wall, cpu=cpu, peak_rss_mb=peak_rss_mb(), samples=samples,
+                samples_per_sec=samples / max(wall, 1e-9), feed=feed, compute=compute, evaluate=evaluate, **fields)
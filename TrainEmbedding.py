@@ -1,14 +1,14 @@
 import datetime
 import logging
 import os
-import shutil
 import sys
 import time
 import tensorflow as tf
 import numpy as np
 import math
-from scipy import sparse
 from HyperParameter import *
+from Telemetry import record_stage, record_epoch, cpu_time
+from ArtifactStore import save_array, load_array, load_sparse
 
 def cosine_similarity(num1, num2):
     num1 = tf.cast(num1, tf.float32)
@@ -21,42 +21,112 @@ def cosine_similarity(num1, num2):
     return cosine
 
 
+# cosine similarity of each row of num1 with the same row of num2
+def pair_cosine_similarity(num1, num2):
+    inner = tf.reduce_sum(num1 * num2, axis=1)
+    norm = tf.sqrt(tf.reduce_sum(tf.square(num1), axis=1)) * tf.sqrt(tf.reduce_sum(tf.square(num2), axis=1))
+    return inner / norm
+
+
 starttime = time.time()
 datafolder = os.path.join(dataset, 'Data')
-modelfolder = os.path.join(dataset, 'Model')
+modelfolder = os.path.join(dataset, model_dir)
 
-if os.path.exists(modelfolder):
-    # delete old folder and create a new folder
-    shutil.rmtree(modelfolder)
-    os.mkdir(modelfolder)
-else:
-    os.mkdir(modelfolder)
+# old embeddings are overwritten, other files in model folder are kept
+os.makedirs(modelfolder, exist_ok=True)
 
-# load related data
-pro_skill_true = sparse.load_npz(os.path.join(dataset, 'Data/pro_skill_sparse.npz'))
-pro_pro_true = sparse.load_npz(os.path.join(dataset, 'Data/pro_pro_sparse.npz'))
-skill_skill_true = sparse.load_npz(os.path.join(dataset, 'Data/skill_skill_sparse.npz'))
-pro_diff_true = sparse.load_npz(os.path.join(dataset, 'Data/pro_diff_sparse.npz'))
-skill_diff_true = sparse.load_npz(os.path.join(dataset, 'Data/skill_diff_sparse.npz'))
-stu_skill_true = sparse.load_npz(os.path.join(dataset, 'Data/stu_skill_sparse.npz'))
+# load related data, arrays are memory-mapped and shared with other runs reading the same files
+pro_skill_true = load_sparse(os.path.join(dataset, 'Data/pro_skill_sparse.npz'))
+pro_pro_true = load_sparse(os.path.join(dataset, 'Data/pro_pro_sparse.npz'))
+skill_skill_true = load_sparse(os.path.join(dataset, 'Data/skill_skill_sparse.npz'))
+pro_diff_true = load_sparse(os.path.join(dataset, 'Data/pro_diff_sparse.npz'))
+skill_diff_true = load_sparse(os.path.join(dataset, 'Data/skill_diff_sparse.npz'))
+stu_skill_true = load_sparse(os.path.join(dataset, 'Data/stu_skill_sparse.npz'))
 
 # convert related data to arrays
-pro_skill_dense = pro_skill_true.toarray()
-pro_pro_dense = pro_pro_true.toarray()
+# problem-problem, problem-skill and student-skill relationships are saved in CSR form,
+# so they stay memory-mapped without copies and are densified batch by batch, only small matrices are dense
+pro_pro_csr = pro_pro_true.tocsr()
+pro_skill_csr = pro_skill_true.tocsr()
 skill_skill_dense = skill_skill_true.toarray()
 pro_diff_dense = pro_diff_true.toarray()
 skill_diff_dense = skill_diff_true.toarray()
-stu_skill_dense = stu_skill_true.toarray()
+# student-skill mastery stays sparse, only answered (student, skill) pairs are stored
+stu_skill_csr = stu_skill_true.tocsr()
 
 [num_pro, num_skill], num_stu = pro_skill_true.shape, stu_skill_true.shape[0]
 
-tf_pro = tf.placeholder(tf.int32, [None])
-tf_pro_skill_targets = tf.placeholder(tf.float32, [None, num_skill], name='tf_pro_skill')
-tf_pro_pro_targets = tf.placeholder(tf.float32, [None, num_pro], name='tf_pro_pro')
-tf_skill_skill_targets = tf.placeholder(tf.float32, [num_skill, num_skill], name='tf_skill_skill')
-tf_pro_diff_target = tf.placeholder(tf.float32, [1, None], name='tf_pro_diff')
-tf_skill_diff_target = tf.placeholder(tf.float32, [1, num_skill], name='tf_skill_diff')
-tf_stu_skill_target = tf.placeholder(tf.float32, [num_stu, num_skill], name='tf_stu_skill')
+# problems and students trained on, in incremental mode only those with new records since the previous run
+if incremental:
+    train_pro = load_array(datafolder, 'delta_pro', mmap_mode=None)
+    train_stu = load_array(datafolder, 'delta_stu', mmap_mode=None)
+else:
+    train_pro, train_stu = np.arange(num_pro, dtype=np.int32), np.arange(num_stu, dtype=np.int32)
+# the exact student-skill loss uses all students at every step, in incremental mode students are sampled from train_stu instead
+sample_students = stu_skill_loss == "sampled" or incremental
+
+train_steps = int(math.ceil(len(train_pro) / float(bs)))
+
+
+"""
+sample problem-problem pairs of problems pro_ids: all related pairs, and num_neg random problems for each problem,
+a sampled problem that is related is already counted in related pairs and gets weight 0
+"""
+def sample_pro_pro(pro_ids):
+    pos = pro_pro_csr[pro_ids].tocoo()
+    neg_row = np.repeat(np.arange(len(pro_ids)), num_neg).astype(np.int32)
+    neg_col = np.random.randint(0, num_pro, len(neg_row)).astype(np.int32)
+    neg_weight = (np.asarray(pro_pro_csr[pro_ids[neg_row], neg_col]).ravel() == 0).astype(np.float32)
+    return {'pos_row': pos.row.astype(np.int32), 'pos_col': pos.col.astype(np.int32), 'pos_label': pos.data.astype(np.float32),
+            'neg_row': neg_row, 'neg_col': neg_col, 'neg_weight': neg_weight}
+
+
+# number of students sampled at each step, students are visited in a random order and each of them once per epoch
+stu_bs = int(math.ceil(len(train_stu) / float(max(train_steps, 1))))
+
+
+# time spent preparing batches
+timing = {'feed': 0.}
+
+
+# batches of problems and their targets, in the same order in every epoch
+def batch_generator():
+    while True:
+        if sample_students:
+            stu_perm = np.random.permutation(train_stu).astype(np.int32)
+        for m in range(train_steps):
+            feedstarttime = time.time()
+            pro_ids = train_pro[m * bs:(m + 1) * bs].astype(np.int32)
+            batch = {'pro': pro_ids, 'pro_skill': pro_skill_csr[pro_ids].toarray(), 'pro_diff': pro_diff_dense[:, pro_ids]}
+            if pro_pro_loss == "sampled":
+                batch.update(sample_pro_pro(pro_ids))
+            else:
+                batch['pro_pro'] = pro_pro_csr[pro_ids].toarray()
+            if sample_students:
+                batch['stu'] = stu_perm.take(np.arange(m * stu_bs, (m + 1) * stu_bs), mode='wrap')
+                batch['stu_skill'] = stu_skill_csr[batch['stu']].toarray()
+            timing['feed'] += time.time() - feedstarttime
+            yield batch
+
+
+batch_types = {'pro': tf.int32, 'pro_skill': tf.float32, 'pro_diff': tf.float32}
+batch_shapes = {'pro': [None], 'pro_skill': [None, num_skill], 'pro_diff': [1, None]}
+if pro_pro_loss == "sampled":
+    batch_types.update({'pos_row': tf.int32, 'pos_col': tf.int32, 'pos_label': tf.float32, 'neg_row': tf.int32, 'neg_col': tf.int32, 'neg_weight': tf.float32})
+    batch_shapes.update({key: [None] for key in ['pos_row', 'pos_col', 'pos_label', 'neg_row', 'neg_col', 'neg_weight']})
+else:
+    batch_types['pro_pro'], batch_shapes['pro_pro'] = tf.float32, [None, num_pro]
+if sample_students:
+    batch_types.update({'stu': tf.int32, 'stu_skill': tf.float32})
+    batch_shapes.update({'stu': [None], 'stu_skill': [None, num_skill]})
+# batches are prepared in background and prefetched while the previous step is running
+batch_dataset = tf.data.Dataset.from_generator(batch_generator, batch_types, batch_shapes)
+batch_iterator = tf.data.make_one_shot_iterator(batch_dataset.prefetch(tf.data.experimental.AUTOTUNE))
+tf_batch = batch_iterator.get_next()
+tf_pro, tf_pro_skill_targets, tf_pro_diff_target = tf_batch['pro'], tf_batch['pro_skill'], tf_batch['pro_diff']
+# targets that are the same for every batch are put into graph once
+tf_skill_skill_targets = tf.constant(skill_skill_dense, tf.float32, name='tf_skill_skill')
+tf_skill_diff_target = tf.constant(skill_diff_dense, tf.float32, name='tf_skill_diff')
 
 # problem data embedding matrix
 pro_data_embedding_matrix = tf.get_variable('pro_data_embed_matrix', [num_pro, embed_dim], initializer=tf.truncated_normal_initializer(stddev=0.1))
@@ -70,15 +140,34 @@ pro_diff_embedding_matrix = tf.get_variable('pro_diff_embed_matrix', [num_pro, e
 skill_diff_embedding_matrix = tf.get_variable('skill_diff_embed_matrix', [num_skill, embed_dim], initializer=tf.truncated_normal_initializer(stddev=0.1))
 # calculate skill embedding after adding weights
 skill_embedding_matrix = tf.multiply(skill_embedding_matrix, tf.nn.softmax(skill_embedding_matrix, axis=0))
-# calculate problem-related skill embedding matrix
-pro_skill_embedding_matrix = tf.matmul(pro_skill_dense, skill_embedding_matrix)
-# calculate problem embedding matrix
-pro_data_sum = tf.reshape(tf.reduce_sum(pro_data_embedding_matrix, 1), (-1, 1))
-pro_skill_sum = tf.reshape(tf.reduce_sum(pro_skill_embedding_matrix, 1), (-1, 1))
-pro_rate = tf.exp(pro_data_sum) / (tf.exp(pro_data_sum) + tf.exp(pro_skill_sum))
-pro_embedding_matrix = pro_rate * pro_data_embedding_matrix + (1 - pro_rate) * pro_skill_embedding_matrix
-
-pro_embed = tf.nn.embedding_lookup(pro_embedding_matrix, tf_pro)
+# problem-skill relationships in CSR form: skills of problem i are at positions offsets[i] to offsets[i + 1]
+tf_pro_skill_offsets = tf.constant(pro_skill_csr.indptr.astype(np.int64))
+tf_pro_skill_indices = tf.constant(pro_skill_csr.indices.astype(np.int32))
+tf_pro_skill_values = tf.constant(pro_skill_csr.data.astype(np.float32))
+
+
+# calculate problem-related skill embedding of given problems = sum of embeddings of their skills
+def pro_skill_embedding(pro_ids):
+    pos = tf.ragged.range(tf.gather(tf_pro_skill_offsets, pro_ids), tf.gather(tf_pro_skill_offsets, pro_ids + 1))
+    skill_embed = tf.gather(skill_embedding_matrix, tf.gather(tf_pro_skill_indices, pos.values))
+    skill_embed = skill_embed * tf.reshape(tf.gather(tf_pro_skill_values, pos.values), (-1, 1))
+    return tf.math.unsorted_segment_sum(skill_embed, pos.value_rowids(), tf.shape(pro_ids)[0])
+
+
+# calculate problem embedding of given problems, only their rows are computed
+def pro_embedding(pro_ids):
+    pro_data_embed = tf.gather(pro_data_embedding_matrix, pro_ids)
+    pro_skill_embed = pro_skill_embedding(pro_ids)
+    pro_data_sum = tf.reshape(tf.reduce_sum(pro_data_embed, 1), (-1, 1))
+    pro_skill_sum = tf.reshape(tf.reduce_sum(pro_skill_embed, 1), (-1, 1))
+    pro_rate = tf.exp(pro_data_sum) / (tf.exp(pro_data_sum) + tf.exp(pro_skill_sum))
+    return pro_rate * pro_data_embed + (1 - pro_rate) * pro_skill_embed
+
+
+# embedding matrix of all problems, only needed by exact problem-problem loss and final embeddings
+pro_embedding_matrix = pro_embedding(tf.range(num_pro))
+
+pro_embed = pro_embedding(tf_pro)
 pro_diff_embed = tf.nn.embedding_lookup(pro_diff_embedding_matrix, tf_pro)
 
 # optimization of problem-skill relationships
@@ -88,10 +177,21 @@ tf_pro_skill_labels = tf.reshape(tf_pro_skill_targets, [-1])
 mse_pro_skill = tf.reduce_mean(tf.square(tf_pro_skill_labels - tf_pro_skill_logits))
 
 # optimization of problem-problem relationships
-tf_pro_pro_logits = cosine_similarity(pro_embed, pro_embedding_matrix)
-tf_pro_pro_logits = tf.reshape(tf_pro_pro_logits, [-1])
-tf_pro_pro_labels = tf.reshape(tf_pro_pro_targets, [-1])
-mse_pro_pro = tf.reduce_mean(tf.square(tf_pro_pro_labels - tf_pro_pro_logits))
+if pro_pro_loss == "sampled":
+    """
+    mse over all batch size * num_pro pairs is estimated without bias:
+    related pairs are counted exactly, unrelated pairs (label 0) through num_neg sampled problems for each problem
+    """
+    tf_pos_logits = pair_cosine_similarity(tf.gather(pro_embed, tf_batch['pos_row']), pro_embedding(tf_batch['pos_col']))
+    tf_neg_logits = pair_cosine_similarity(tf.gather(pro_embed, tf_batch['neg_row']), pro_embedding(tf_batch['neg_col']))
+    tf_pro_pro_square = tf.reduce_sum(tf.square(tf_batch['pos_label'] - tf_pos_logits)) + \
+                        num_pro / num_neg * tf.reduce_sum(tf_batch['neg_weight'] * tf.square(tf_neg_logits))
+    mse_pro_pro = tf_pro_pro_square / tf.cast(tf.shape(tf_pro)[0] * num_pro, tf.float32)
+else:
+    tf_pro_pro_logits = cosine_similarity(pro_embed, pro_embedding_matrix)
+    tf_pro_pro_logits = tf.reshape(tf_pro_pro_logits, [-1])
+    tf_pro_pro_labels = tf.reshape(tf_batch['pro_pro'], [-1])
+    mse_pro_pro = tf.reduce_mean(tf.square(tf_pro_pro_labels - tf_pro_pro_logits))
 
 # optimization of skill-skill relationships
 tf_skill_skill_logits = cosine_similarity(skill_embedding_matrix, skill_embedding_matrix)
@@ -112,10 +212,27 @@ tf_skill_diff_labels = tf.reshape(tf_skill_diff_target, [-1])
 mse_skill_diff = tf.reduce_mean(tf.square(tf_skill_diff_logits - tf_skill_diff_labels))
 
 # optimization of student's mastery degree of skills
-tf_stu_skill_logits = tf.matmul(stu_embedding_matrix, tf.transpose(skill_embedding_matrix))
-tf_stu_skill_logits = tf.reshape(tf_stu_skill_logits, [-1])
-tf_stu_skill_labels = tf.reshape(tf_stu_skill_target, [-1])
-mse_stu_skill = tf.reduce_mean(tf.square(tf_stu_skill_labels - tf_stu_skill_logits))
+if sample_students:
+    # mse over rows of sampled students, each row is sampled with the same probability, so it equals the full mse in expectation
+    tf_stu_skill_logits = tf.matmul(tf.gather(stu_embedding_matrix, tf_batch['stu']), skill_embedding_matrix, transpose_b=True)
+    mse_stu_skill = tf.reduce_mean(tf.square(tf_batch['stu_skill'] - tf_stu_skill_logits))
+else:
+    # the exact loss puts all stored pairs into the graph
+    stu_skill_coo = stu_skill_csr.tocoo()
+    tf_stu_skill_labels = tf.constant(stu_skill_coo.data, tf.float32)
+    tf_stu_skill_stu = tf.constant(stu_skill_coo.row, tf.int32)
+    tf_stu_skill_skill = tf.constant(stu_skill_coo.col, tf.int32)
+    # logits of the stored pairs
+    tf_stu_skill_logits = tf.reduce_sum(tf.gather(stu_embedding_matrix, tf_stu_skill_stu) * tf.gather(skill_embedding_matrix, tf_stu_skill_skill), 1)
+    """
+    mse is still taken over all num_stu * num_skill entries, unstored entries have label 0,
+    so their squared error is the sum of all squared logits minus that of stored pairs,
+    and the sum of all squared logits equals the sum of the elementwise product of the two gram matrices
+    """
+    tf_stu_skill_all_square = tf.reduce_sum(tf.matmul(stu_embedding_matrix, stu_embedding_matrix, transpose_a=True) *
+                                            tf.matmul(skill_embedding_matrix, skill_embedding_matrix, transpose_a=True))
+    tf_stu_skill_square = tf.reduce_sum(tf.square(tf_stu_skill_labels - tf_stu_skill_logits)) + tf_stu_skill_all_square - tf.reduce_sum(tf.square(tf_stu_skill_logits))
+    mse_stu_skill = tf_stu_skill_square / (num_stu * num_skill)
 
 # overall optimization
 loss = mse_pro_skill + mse_pro_pro + mse_skill_skill + mse_pro_diff + mse_skill_diff + mse_stu_skill
@@ -124,9 +241,6 @@ train_op = optimizer.minimize(loss)
 
 # set log file to store the running results
 logfile = os.path.join(modelfolder, "trainEmbedding.txt")
-# delete log file content before each run
-f = open(logfile, "wb+")
-f.truncate()
 logging.basicConfig(filename=logfile, level="DEBUG")
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
@@ -134,34 +248,49 @@ startTraintime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 logging.info(os.linesep + '-' * 45 + ' BEGIN: ' + startTraintime + ' ' + '-' * 45)
 logging.info('dataset %s, problem number %d, skill number %d, student number %d' % (dataset, num_pro, num_skill, num_stu))
 
-train_steps = int(math.ceil(num_pro / float(bs)))
 
+# previous parameters are copied into the rows of existing problems, skills and students, rows of new ones keep their initial values
+def warm_start(sess):
+    for var in tf.trainable_variables():
+        path = os.path.join(modelfolder, 'param_%s.npy' % var.op.name)
+        if not os.path.exists(path):
+            continue
+        previous, value = np.load(path), sess.run(var)
+        if previous.shape[1:] != value.shape[1:]:
+            logging.info("%s of the previous run has shape %s, not used" % (var.op.name, previous.shape))
+            continue
+        rows = min(len(previous), len(value))
+        value[:rows] = previous[:rows]
+        var.load(value, sess)
+        logging.info("%s starts from the previous run, %d new rows" % (var.op.name, len(value) - rows))
+
+
+if incremental:
+    logging.info('incremental training on %d problems and %d students with new records' % (len(train_pro), len(train_stu)))
 logging.info("begin training....")
-with tf.Session() as sess:
+# thread pools of TensorFlow are bounded so that several runs can share the cores, 0 means TensorFlow's default
+session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads, inter_op_parallelism_threads=inter_threads)
+with tf.Session(config=session_config) as sess, record_stage('train_embedding', len(train_pro)):
     sess.run(tf.global_variables_initializer())
+    if incremental:
+        warm_start(sess)
     best_loss, tmp, Loss = np.inf, 0, np.zeros(epochs)
-    for i in range(epochs):
-        epochstarttime = time.time()
+    # nothing is trained when no problem has new records
+    for i in range(epochs if train_steps else 0):
+        epochstarttime, epochstartcpu, epochstartfeed = time.time(), cpu_time(), timing['feed']
         train_loss = 0
         for m in range(train_steps):
-            b, e = m * bs, min((m + 1) * bs, num_pro)
-            batch_pro = np.arange(b, e).astype(np.int32)
-            batch_pro_pro = pro_pro_dense[b:e:]
-            batch_pro_skill = pro_skill_dense[b:e:]
-            batch_pro_diff = pro_diff_dense[:, b:e]
-            feed_dict = {tf_pro: batch_pro,
-                         tf_pro_skill_targets: batch_pro_skill,
-                         tf_pro_pro_targets: batch_pro_pro,
-                         tf_skill_skill_targets: skill_skill_dense,
-                         tf_pro_diff_target: batch_pro_diff,
-                         tf_skill_diff_target: skill_diff_dense,
-                         tf_stu_skill_target: stu_skill_dense}
-            _, loss_ = sess.run([train_op, loss], feed_dict=feed_dict)
+            _, loss_ = sess.run([train_op, loss])
             train_loss += loss_
         train_loss /= train_steps
         epochendtime = time.time()
         logging.info("epoch %d, loss %f, time %f" % (i + 1, train_loss, epochendtime - epochstarttime))
+        record_epoch('train_embedding', i + 1, epochendtime - epochstarttime, cpu_time() - epochstartcpu, len(train_pro),
+                     feed=timing['feed'] - epochstartfeed, compute=epochendtime - epochstarttime, loss=float(train_loss))
         Loss[i] = train_loss
+        if converge_tol and i > 0 and Loss[i - 1] - train_loss < converge_tol * abs(Loss[i - 1]):
+            logging.info("Converged at %d, loss improved less than %g." % (i + 1, converge_tol))
+            break
         if i >= early_stop:
             if all(x <= y for x, y in zip(Loss[tmp:tmp + early_stop], Loss[tmp + 1:tmp + 1 + early_stop])):
                 logging.info("Early stop at %d based on loss result." % (i + 1))
@@ -181,9 +310,13 @@ with tf.Session() as sess:
     final_stu_embed = final_stu_embed.eval()
     final_stu_embed = np.array(final_stu_embed)
 
-    np.savez(os.path.join(modelfolder, 'final_pro_embed.npz'), final_pro_embed=final_pro_embed)
-    np.savez(os.path.join(modelfolder, 'final_skill_embed.npz'), final_skill_embed=final_skill_embed)
-    np.savez(os.path.join(modelfolder, 'final_stu_embed.npz'), final_stu_embed=final_stu_embed)
+    # embeddings are stored as float32 .npy files, later programs open them memory-mapped
+    save_array(modelfolder, 'final_pro_embed', final_pro_embed.astype(np.float32))
+    save_array(modelfolder, 'final_skill_embed', final_skill_embed.astype(np.float32))
+    save_array(modelfolder, 'final_stu_embed', final_stu_embed.astype(np.float32))
+    # parameters are kept for warm starting incremental runs
+    for var in tf.trainable_variables():
+        save_array(modelfolder, 'param_%s' % var.op.name, sess.run(var))
 
 endTraintime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 logging.info(os.linesep + '-' * 45 + ' END: ' + endTraintime + ' ' + '-' * 45)
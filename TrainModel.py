@@ -1,4 +1,5 @@
 import datetime
+import json
 import logging
 import os
 import sys
@@ -8,34 +9,81 @@ import numpy as np
 from sklearn import metrics
 import math
 from HyperParameter import *
+from ArtifactStore import load_manifest, load_array, save_array, load_npz_mmap
+from JointEmbedding import pad_line_skills, joint_embedding
+from Telemetry import record_stage, record_epoch, cpu_time
+from Metrics import new_evaluator, update_evaluator, evaluator_auc, evaluator_acc
 
 
 starttime = time.time()
 datafolder = os.path.join(dataset, "Data")
-modelfolder = os.path.join(dataset, 'Model')
-with open(os.path.join(datafolder, 'num_pro.txt'), 'r') as f:
-    num_pro = eval(f.read())
-with open(os.path.join(datafolder, 'num_skill.txt'), 'r') as f:
-    num_skill = eval(f.read())
-with open(os.path.join(datafolder, 'num_stu.txt'), 'r') as f:
-    num_stu = eval(f.read())
-
-if dataset == "Assist09":
-    with open(os.path.join(datafolder, 'max_skill_len.txt'), 'r') as f:
-        max_skill_len = eval(f.read())
+modelfolder = os.path.join(dataset, model_dir)
+manifest = load_manifest(datafolder)
+num_pro, num_skill, num_stu = manifest['num_pro'], manifest['num_skill'], manifest['num_stu']
+max_skill_len = manifest['max_skill_len']
+
+if joint_mode == "fused":
+    # joint embeddings are computed batch by batch from final embeddings, JointEmbedding.py does not need to be run
+    stu_pro_skill_corr = load_npz_mmap(os.path.join(datafolder, "stu_pro_skill_corr.npz"))
+    line_stu, line_pro, final_true_corr = stu_pro_skill_corr["stu"], stu_pro_skill_corr["pro"], stu_pro_skill_corr["correct"]
+    skill_offsets, skill_indices = stu_pro_skill_corr["skill_offsets"], stu_pro_skill_corr["skill_indices"]
+    final_pro_embed = load_array(modelfolder, "final_pro_embed")
+    final_skill_embed = load_array(modelfolder, "final_skill_embed")
+    final_stu_embed = load_array(modelfolder, "final_stu_embed")
+
+
+    # joint embeddings of lines b to e
+    def joint_batch(b, e):
+        padded_skills, mask = pad_line_skills(skill_offsets, skill_indices, b, e, max_skill_len)
+        return joint_embedding(final_stu_embed, final_pro_embed, final_skill_embed, line_stu[b:e], line_pro[b:e], padded_skills, mask)
 else:
-    max_skill_len = 1
+    # opened memory-mapped, batches are read from page cache shared with other processes
+    final_joint_embed = load_array(modelfolder, "final_joint_embed")
+    final_true_corr = load_array(modelfolder, "final_true_corr")
 
-final_joint_embed = np.load(os.path.join(modelfolder, "final_joint_embed.npz"), allow_pickle=True)["final_joint_embed"]
-final_true_corr = np.load(os.path.join(modelfolder, "final_true_corr.npz"), allow_pickle=True)["final_true_corr"]
 
-data_num = len(final_joint_embed)
+    def joint_batch(b, e):
+        return final_joint_embed[b:e]
+
+# the first split_point lines are training set, the rest are test set
+data_num = len(final_true_corr)
 split_point = int(data_num * split_rate)
-train_joint_data, train_corr_data = final_joint_embed[:split_point], final_true_corr[:split_point]
-test_joint_data, test_corr_data = final_joint_embed[split_point:], final_true_corr[split_point:]
+train_num, test_num = split_point, data_num - split_point
+
+train_steps = int(math.ceil(train_num / float(bs)))
+test_steps = int(math.ceil(test_num / float(eval_bs)))
+
+
+# time spent preparing training batches
+timing = {'feed': 0.}
+
+
+# training lines are read shuffle_batches batches at a time in random order, lines read together are shuffled and split into batches
+def train_generator():
+    block = bs * shuffle_batches
+    for b in np.random.permutation(np.arange(0, train_num, block)):
+        feedstarttime = time.time()
+        e = min(b + block, train_num)
+        perm = np.random.permutation(e - b)
+        batch_embed, batch_corr = joint_batch(b, e)[perm], final_true_corr[b:e][perm]
+        timing['feed'] += time.time() - feedstarttime
+        for k in range(0, e - b, bs):
+            yield batch_embed[k:k + bs].astype(np.float32), batch_corr[k:k + bs].astype(np.float32)
+
 
-tf_embed_target = tf.placeholder(tf.float32, [None, None], name='tf_data_embed')
-tf_corr_target = tf.placeholder(tf.float32, [None], name='tf_data_corr')
+def test_generator():
+    for b in range(split_point, data_num, eval_bs):
+        e = min(b + eval_bs, data_num)
+        yield joint_batch(b, e).astype(np.float32), final_true_corr[b:e].astype(np.float32)
+
+
+# batches are prepared in background while the previous batch is trained, the same iterator switches between training and test set
+batch_types, batch_shapes = (tf.float32, tf.float32), (tf.TensorShape([None, 1 + max_skill_len]), tf.TensorShape([None]))
+train_dataset = tf.data.Dataset.from_generator(train_generator, batch_types, batch_shapes).prefetch(tf.data.experimental.AUTOTUNE)
+test_dataset = tf.data.Dataset.from_generator(test_generator, batch_types, batch_shapes).prefetch(tf.data.experimental.AUTOTUNE)
+batch_iterator = tf.data.Iterator.from_structure(batch_types, batch_shapes)
+train_init, test_init = batch_iterator.make_initializer(train_dataset), batch_iterator.make_initializer(test_dataset)
+tf_embed_target, tf_corr_target = batch_iterator.get_next()
 tf_keep_rate = tf.placeholder(tf.float32, None, name="tf_keep_rate")
 
 pred_w = tf.get_variable('pred_w', [1, 1 + max_skill_len], initializer=tf.truncated_normal_initializer(stddev=0.1))
@@ -51,57 +99,67 @@ optimizer = tf.train.AdamOptimizer(learning_rate=lr)
 train_op = optimizer.minimize(loss)
 
 logfile = os.path.join(modelfolder, "trainModel.txt")
-f = open(logfile, "wb+")
-f.truncate()
 logging.basicConfig(filename=logfile, level="DEBUG")
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
 startTraintime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 logging.info(os.linesep + '-' * 45 + ' BEGIN: ' + startTraintime + ' ' + '-' * 45)
 logging.info('dataset %s, problem number %d, skill number %d, student number %d' % (dataset, num_pro, num_skill, num_stu))
-logging.info("data_num {0},train_data_num {1},test_data_num {2}".format(data_num, len(train_joint_data), len(test_joint_data)))
+logging.info("data_num {0},train_data_num {1},test_data_num {2}".format(data_num, train_num, test_num))
+
+
+# acc and auc of test set, bucketed auc is computed batch by batch, exact auc keeps all predictions and sorts them
+def evaluate(sess, exact=False):
+    evaluator, test_preds, test_trues = new_evaluator(auc_buckets), [], []
+    sess.run(test_init)
+    for j in range(test_steps):
+        pred_corr, true_corr = sess.run([tf_corr_logits, tf_corr_labels], feed_dict={tf_keep_rate: 1})
+        update_evaluator(evaluator, pred_corr, true_corr)
+        if exact:
+            test_preds.append(pred_corr)
+            test_trues.append(true_corr)
+    if not exact:
+        return evaluator_acc(evaluator), evaluator_auc(evaluator)
+    test_preds = np.concatenate(test_preds, axis=0)
+    test_trues = np.concatenate(test_trues, axis=0)
+    test_auc = metrics.roc_auc_score(test_trues, test_preds)
+    test_preds[test_preds >= 0.5] = 1.
+    test_preds[test_preds < 0.5] = 0.
+    return metrics.accuracy_score(test_trues, test_preds), test_auc
 
-train_steps = int(math.ceil(len(train_joint_data) / float(bs)))
-test_steps = int(math.ceil(len(test_joint_data) / float(bs)))
 
 logging.info("begin training....")
-with tf.Session() as sess:
+# thread pools of TensorFlow are bounded so that several runs can share the cores, 0 means TensorFlow's default
+session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads, inter_op_parallelism_threads=inter_threads)
+with tf.Session(config=session_config) as sess, record_stage('train_model', data_num):
     sess.run(tf.global_variables_initializer())
-    best_auc = best_acc = 0
+    best_auc = best_acc = best_epoch = 0
+    best_w, best_b = sess.run([pred_w, pred_b])
     tmp, Loss = 0, np.zeros(epochs)
     for i in range(epochs):
-        epochstarttime = time.time()
+        epochstarttime, epochstartcpu, epochstartfeed = time.time(), cpu_time(), timing['feed']
         train_loss = 0
+        sess.run(train_init)
         for j in range(train_steps):
-            b, e = j * bs, min((j + 1) * bs, len(train_joint_data))
-            batch_train_embed = train_joint_data[b:e:]
-            batch_train_corr = train_corr_data[b:e:]
-            feed_dict = {tf_embed_target: batch_train_embed, tf_corr_target: batch_train_corr, tf_keep_rate: keep_rate}
-            _, batch_loss = sess.run([train_op, loss], feed_dict=feed_dict)
+            _, batch_loss = sess.run([train_op, loss], feed_dict={tf_keep_rate: keep_rate})
             train_loss += batch_loss
         train_loss /= train_steps
-        test_preds, test_trues = [], []
-        for j in range(test_steps):
-            b, e = j * bs, min((j + 1) * bs, len(test_joint_data))
-            batch_test_embed = test_joint_data[b:e:]
-            batch_test_corr = test_corr_data[b:e:]
-            feed_dict = {tf_embed_target: batch_test_embed, tf_corr_target: batch_test_corr, tf_keep_rate: 1}
-            pred_corr, true_corr = sess.run([tf_corr_logits, tf_corr_labels], feed_dict=feed_dict)
-            test_preds.append(pred_corr)
-            test_trues.append(true_corr)
-        test_preds = np.concatenate(test_preds, axis=0)
-        test_trues = np.concatenate(test_trues, axis=0)
-        test_auc = metrics.roc_auc_score(test_trues, test_preds)
-        test_preds[test_preds >= 0.5] = 1.
-        test_preds[test_preds < 0.5] = 0.
-        test_acc = metrics.accuracy_score(test_trues, test_preds)
+        traintime = time.time() - epochstarttime
+        test_acc, test_auc = evaluate(sess)
+        testtime = time.time() - epochstarttime - traintime
         epochendtime = time.time()
-        records = 'Epoch %d/%d, train loss:%.4f, test acc:%.4f, test auc:%.4f, epoch time:%f' % \
-                  (i + 1, epochs, train_loss, test_acc, test_auc, epochendtime - epochstarttime)
+        records = 'Epoch %d/%d, train loss:%.4f, test acc:%.4f, test auc:%.4f, epoch time:%f, train samples/s:%.0f, test samples/s:%.0f' % \
+                  (i + 1, epochs, train_loss, test_acc, test_auc, epochendtime - epochstarttime, train_num / traintime, test_num / testtime)
         logging.info(records)
+        record_epoch('train_model', i + 1, epochendtime - epochstarttime, cpu_time() - epochstartcpu, train_num,
+                     feed=timing['feed'] - epochstartfeed, compute=traintime, evaluate=testtime,
+                     loss=float(train_loss), acc=float(test_acc), auc=float(test_auc))
         if best_acc + best_auc <= test_acc + test_auc:
             best_acc = test_acc
             best_auc = test_auc
+            best_epoch = i + 1
+            # prediction weights of the best epoch are kept for ScoringService.py
+            best_w, best_b = sess.run([pred_w, pred_b])
         Loss[i] = round(train_loss, 4)
         if i >= early_stop:
             if all(x <= y for x, y in zip(Loss[tmp:tmp + early_stop], Loss[tmp + 1:tmp + 1 + early_stop])):
@@ -109,9 +167,24 @@ with tf.Session() as sess:
                 break
             tmp += 1
     logging.info("best acc:%.4f   best auc:%.4f" % (best_acc, best_auc))
+    results = {'best_acc': float(best_acc), 'best_auc': float(best_auc), 'best_epoch': best_epoch, 'epochs_run': i + 1}
+    save_array(modelfolder, 'pred_w', best_w)
+    save_array(modelfolder, 'pred_b', best_b)
+    if exact_auc:
+        # the exact evaluation describes the saved model of the best epoch, not the last one
+        pred_w.load(best_w, sess)
+        pred_b.load(best_b, sess)
+        final_acc, final_auc = evaluate(sess, exact=True)
+        logging.info("final exact acc:%.4f   final exact auc:%.4f" % (final_acc, final_auc))
+        results.update(final_acc=float(final_acc), final_auc=float(final_auc))
 
 endTraintime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 logging.info(os.linesep + '-' * 45 + ' END: ' + endTraintime + ' ' + '-' * 45)
 
 endtime = time.time()
 logging.info("total time %f" % (endtime - starttime))
+
+# results of the run are also saved in machine-readable form, Sweep.py collects them into one table
+results['time'] = endtime - starttime
+with open(os.path.join(modelfolder, 'results.json'), 'w') as f:
+    json.dump(results, f, indent=2)